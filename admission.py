@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""Decides which commands are run, and in what order, when more
+arrive than the bot can serve at once"""
+
+import sys
+import time
+import heapq
+import asyncio
+import logging
+from itertools import count
+
+from outbound import TokenBuckets
+from metrics import registry
+
+# Guard against python2
+if sys.version_info[0] < 3:
+    raise RuntimeError("Python 3 is required")
+
+logger = logging.getLogger(__name__)
+
+# Command priorities, lowest first
+LOCAL, FETCH, BATCH = 0, 1, 2
+
+
+class AdmissionControl:
+    """ Runs at most `max_inflight` commands at a time.  Commands waiting
+    for a slot are kept in a priority queue, so local commands go ahead
+    of fetches, and `reserved` slots are kept for local commands alone:
+    help and ping are answered even while every other slot is waiting
+    on xkcd.
+
+    A command is shed instead of queued when its user or channel is out
+    of tokens, or when `maxsize` commands are already waiting.  A full
+    queue does not shed a local command while a slot is free for it:
+    it goes ahead of the waiting fetches and starts at once."""
+
+    def __init__(self, max_inflight=16, reserved=2, maxsize=100,
+                 user_rate=1.0, user_burst=5,
+                 channel_rate=5.0, channel_burst=20, warn_interval=30):
+        self.max_inflight = max_inflight
+        self.reserved = reserved
+        self.maxsize = maxsize
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.warn_interval = warn_interval
+        self.user_buckets = TokenBuckets(user_rate, user_burst)
+        self.channel_buckets = TokenBuckets(channel_rate, channel_burst)
+        self.warned = {}
+        self._warned_sweep_at = self.user_buckets.sweep_size
+        self.waiting = []
+        self.running = set()
+        self._seq = count()
+        self.admitted = 0
+        self.shed = {'user': 0, 'channel': 0, 'full': 0}
+
+    def submit(self, run, priority=FETCH, user=None, chan=None,
+               label='unknown'):
+        """ Queues run(), a coroutine function, to be started when a slot
+        is free.  Returns None, or why the command was shed."""
+        if (len(self.waiting) >= self.maxsize and
+                not (priority == LOCAL and
+                     len(self.running) < self.max_inflight)):
+            reason = 'full'
+        elif not self.user_buckets.get(user).try_take():
+            reason = 'user'
+        elif not self.channel_buckets.get(chan).try_take():
+            reason = 'channel'
+        else:
+            self.admitted += 1
+            heapq.heappush(self.waiting, (priority, next(self._seq),
+                                          time.perf_counter(), label, run))
+            self._pump()
+            return None
+        self.shed[reason] += 1
+        logger.debug(f'Shed a {label} command from {user} in {chan}: '
+                     f'{reason}')
+        return reason
+
+    def should_warn(self, user):
+        """ Whether a shed user is due a slow down reply.  Each user
+        gets at most one per warn_interval, so the replies to a flood
+        do not become a flood of their own."""
+        now = time.monotonic()
+        if now - self.warned.get(user, -self.warn_interval) < \
+                self.warn_interval:
+            return False
+        if user not in self.warned and \
+                len(self.warned) >= self._warned_sweep_at:
+            # a warning older than warn_interval is as good as none
+            self.warned = {key: at for key, at in self.warned.items()
+                           if now - at < self.warn_interval}
+            self._warned_sweep_at = max(self.user_buckets.sweep_size,
+                                        2 * len(self.warned))
+        self.warned[user] = now
+        logger.warning(f'Shedding commands from {user}')
+        return True
+
+    def _pump(self):
+        """ Starts waiting commands while there are slots for them"""
+        while self.waiting:
+            priority = self.waiting[0][0]
+            limit = self.max_inflight
+            if priority != LOCAL:
+                limit -= self.reserved
+            if len(self.running) >= limit:
+                return
+            _, _, queued_at, label, run = heapq.heappop(self.waiting)
+            registry.observe('admit', label, time.perf_counter() - queued_at)
+            task = asyncio.ensure_future(run())
+            self.running.add(task)
+            task.add_done_callback(self._finished)
+
+    def _finished(self, task):
+        self.running.discard(task)
+        self._pump()
+
+    async def drain(self, timeout):
+        """ Waits up to timeout seconds for the running and waiting
+        commands to finish.  Whatever is left is cancelled.  Returns
+        how many commands were abandoned."""
+        deadline = time.monotonic() + timeout
+        while self.running:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.wait(set(self.running), timeout=remaining)
+        abandoned = len(self.running) + len(self.waiting)
+        self.waiting = []
+        for task in self.running:
+            task.cancel()
+        if abandoned:
+            logger.warning(f'Abandoned {abandoned} commands while draining')
+        return abandoned
+
+    def stats(self):
+        """ Returns how many commands are running, waiting and shed"""
+        return {
+            'inflight': len(self.running),
+            'waiting': len(self.waiting),
+            'admitted': self.admitted,
+            'shed_user': self.shed['user'],
+            'shed_channel': self.shed['channel'],
+            'shed_full': self.shed['full'],
+        }
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""Hermetic end-to-end benchmark of the bot.
+
+Starts a fake Slack (RTM websocket + Web API) and a fake xkcd server on
+localhost, runs a real SlackClient against them, replays mention traffic
+at a fixed rate and reports throughput and command-to-reply latency
+percentiles per command type.  Traffic comes in sessions: a channel is
+sent a comic and then a few more commands, each once the last was
+answered, so next, previous and history have a history to work on.
+Every report ends with how many times xkcd was asked, and how many
+fetches were saved by sharing one already in flight.  Run it from the
+repository root:
+
+    python bench/benchmark.py --rate 50 --duration 10
+
+With --burst N it instead sends N uncached comic requests at once and
+reports how long the last reply took next to a single fetch latency:
+with concurrent fetches the two should be about the same.
+
+    python bench/benchmark.py --burst 50
+
+With --batch N it compares, for batch sizes up to N, one command asking
+for that many uncached comics with asking for them one command at a
+time.  A batch is fetched concurrently, so its reply takes about one
+fetch latency whatever its size, and the latency per comic falls as
+1/size.
+
+    python bench/benchmark.py --batch 10
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from itertools import count
+from collections import deque
+
+# Guard against python2
+if sys.version_info[0] < 3:
+    raise RuntimeError("Python 3 is required")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_servers import FakeSlack, FakeXkcd  # noqa: E402
+
+BOT_ID = 'UBOT'
+
+# command text and how often it shows up in synthetic traffic
+SYNTHETIC_MIX = [
+    (lambda: str(random.randint(1, 2000)), 35),
+    (lambda: 'random', 10),
+    (lambda: 'last', 5),
+    (lambda: 'next', 10),
+    (lambda: 'previous', 5),
+    (lambda: 'help', 10),
+    (lambda: 'ping', 10),
+    (lambda: 'history', 5),
+    (lambda: 'search comic', 5),
+    (lambda: ' '.join(str(random.randint(1, 2000)) for _ in range(3)), 5),
+]
+
+
+def create_parser(args):
+    parser = argparse.ArgumentParser(
+        description='End-to-end benchmark against local fake servers')
+    parser.add_argument('-r', '--rate', type=float, default=20,
+                        help='Commands sent per second')
+    parser.add_argument('-d', '--duration', type=float, default=10,
+                        help='Seconds of traffic to send')
+    parser.add_argument('--xkcd-latency', type=float, default=0.05,
+                        help='Seconds the fake xkcd takes to answer')
+    parser.add_argument('--session-length', type=int, default=5,
+                        help='Commands sent to each channel in turn')
+    parser.add_argument('--replay',
+                        help='File of recorded commands, one per line, '
+                             'replayed in order instead of synthetic traffic')
+    parser.add_argument('--burst', type=int, default=0,
+                        help='Send this many uncached comic requests at once '
+                             'instead of steady traffic')
+    parser.add_argument('--batch', type=int, default=0,
+                        help='Compare batched and one by one comic requests '
+                             'for batch sizes up to this')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true',
+                        help='Print the report as json')
+    return parser.parse_args(args)
+
+
+def synthetic_commands():
+    makers, weights = zip(*SYNTHETIC_MIX)
+    while True:
+        yield random.choices(makers, weights)[0]()
+
+
+def replayed_commands(path):
+    with open(path) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    while True:
+        yield from lines
+
+
+def command_type(command):
+    words = command.split()
+    if words[0].isdigit():
+        return '[int] batch' if len(words) > 1 else '[int]'
+    return words[0]
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of a sorted list"""
+    index = max(0, min(len(values) - 1,
+                       int(round(pct / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def report(sent, replies, elapsed):
+    """ Returns throughput and latency percentiles per command type"""
+    by_type = {}
+    for channel, (kind, sent_at) in sent.items():
+        entry = by_type.setdefault(kind, {'sent': 0, 'latencies': []})
+        entry['sent'] += 1
+        if channel in replies:
+            entry['latencies'].append(replies[channel] - sent_at)
+    result = {
+        'sent': len(sent),
+        'replied': len(replies),
+        'elapsed': round(elapsed, 3),
+        'throughput': round(len(replies) / elapsed, 2),
+        'commands': {},
+    }
+    for kind, entry in sorted(by_type.items()):
+        latencies = sorted(entry['latencies'])
+        row = {'sent': entry['sent'], 'replied': len(latencies)}
+        if latencies:
+            for pct in (50, 95, 99):
+                row[f'p{pct}_ms'] = round(percentile(latencies, pct) * 1000, 2)
+        result['commands'][kind] = row
+    return result
+
+
+def print_report(result):
+    print(f"sent {result['sent']}, replied {result['replied']} "
+          f"in {result['elapsed']}s: {result['throughput']} replies/s")
+    print(f"{'command':<14}{'sent':>7}{'replied':>9}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind, row in result['commands'].items():
+        print(f"{kind:<14}{row['sent']:>7}{row['replied']:>9}"
+              f"{row.get('p50_ms', '-'):>10}{row.get('p95_ms', '-'):>10}"
+              f"{row.get('p99_ms', '-'):>10}")
+
+
+async def steady(ns, slack):
+    """ Sends commands at a fixed rate, returns the report.  Each goes
+    to a session channel waiting for its next command, or starts a new
+    session when none is waiting."""
+    sent, replies = {}, {}
+    # the command each channel is waiting on, and how many it has left
+    awaiting, left = {}, {}
+    idle = deque()
+    sessions = count()
+
+    def on_post(received, args):
+        channel = args.get('channel')
+        seq = awaiting.pop(channel, None)
+        if seq is None:
+            return
+        replies[seq] = received
+        if left[channel]:
+            idle.append(channel)
+
+    slack.on_post = on_post
+
+    commands = (replayed_commands(ns.replay) if ns.replay
+                else synthetic_commands())
+    interval = 1 / ns.rate
+    start = time.monotonic()
+    seq = 0
+    while time.monotonic() - start < ns.duration:
+        command = next(commands)
+        if idle:
+            channel = idle.popleft()
+        else:
+            channel = f'C{next(sessions):07d}'
+            left[channel] = ns.session_length
+            if not ns.replay:
+                # a session opens with a comic
+                command = str(random.randint(1, 2000))
+        left[channel] -= 1
+        awaiting[channel] = seq
+        sent[seq] = (command_type(command), time.monotonic())
+        await slack.send_message(f'<@{BOT_ID}> {command}', channel)
+        seq += 1
+        await asyncio.sleep(max(0, start + seq * interval - time.monotonic()))
+
+    # give the last replies a chance to arrive
+    deadline = time.monotonic() + 10
+    while len(replies) < len(sent) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = max(replies.values(), default=time.monotonic()) - start
+    return report(sent, replies, elapsed)
+
+
+async def burst(ns, slack, bot):
+    """ Sends ns.burst uncached comic requests at once, returns how
+    long they took next to one fetch latency"""
+    # so the burst does not also wait for the latest comic number
+    await bot.xkcd.ensure_last()
+    replies = {}
+
+    def on_post(received, args):
+        replies.setdefault(args.get('channel'), received)
+    slack.on_post = on_post
+
+    start = time.monotonic()
+    for n in range(ns.burst):
+        await slack.send_message(f'<@{BOT_ID}> {n + 1}', f'B{n:05d}')
+    deadline = time.monotonic() + 30
+    while len(replies) < ns.burst and time.monotonic() < deadline:
+        await asyncio.sleep(0.005)
+    elapsed = max(replies.values(), default=time.monotonic()) - start
+    return {
+        'burst': ns.burst,
+        'replied': len(replies),
+        'fetch_latency_ms': round(ns.xkcd_latency * 1000, 2),
+        'all_replied_ms': round(elapsed * 1000, 2),
+        'latencies': round(elapsed / ns.xkcd_latency, 2),
+    }
+
+
+def print_burst(result):
+    print(f"{result['replied']} of {result['burst']} concurrent comic "
+          f"requests answered in {result['all_replied_ms']} ms, "
+          f"{result['latencies']}x the {result['fetch_latency_ms']} ms "
+          "fetch latency")
+
+
+async def batch(ns, slack, bot):
+    """ For each batch size up to ns.batch, times one command asking for
+    that many uncached comics, then the same number of single comic
+    commands, each sent once the last was answered"""
+    await bot.xkcd.ensure_last()
+    replies = {}
+
+    def on_post(received, args):
+        replies.setdefault(args.get('channel'), received)
+    slack.on_post = on_post
+    numbers = (n for n in count(1) if n in bot.xkcd.index)
+    channels = (f'A{n:05d}' for n in count())
+
+    async def ask(command):
+        channel = next(channels)
+        sent = time.monotonic()
+        await slack.send_message(f'<@{BOT_ID}> {command}', channel)
+        deadline = sent + 30
+        while channel not in replies and time.monotonic() < deadline:
+            await asyncio.sleep(0.001)
+        return replies.get(channel, time.monotonic()) - sent
+
+    rows = []
+    sizes = [size for size in (1, 2, 5, 10, 20, 50) if size < ns.batch]
+    for size in sizes + [ns.batch]:
+        batched = await ask(' '.join(str(next(numbers))
+                                     for _ in range(size)))
+        one_by_one = 0
+        for _ in range(size):
+            one_by_one += await ask(str(next(numbers)))
+        rows.append({
+            'size': size,
+            'batched_ms': round(batched * 1000, 2),
+            'one_by_one_ms': round(one_by_one * 1000, 2),
+            'per_comic_ms': round(batched / size * 1000, 2),
+        })
+    return {'fetch_latency_ms': round(ns.xkcd_latency * 1000, 2),
+            'sizes': rows}
+
+
+def print_batch(result):
+    print(f"fetch latency {result['fetch_latency_ms']} ms")
+    print(f"{'size':>5}{'batched ms':>12}{'one by one ms':>15}"
+          f"{'ms per comic':>14}")
+    for row in result['sizes']:
+        print(f"{row['size']:>5}{row['batched_ms']:>12}"
+              f"{row['one_by_one_ms']:>15}{row['per_comic_ms']:>14}")
+
+
+async def run(ns):
+    random.seed(ns.seed)
+    xkcd = FakeXkcd(latency=ns.xkcd_latency)
+    slack = FakeSlack(bot_id=BOT_ID)
+    os.environ['XKCD_BASE_URL'] = await xkcd.start()
+    api_url = await slack.start()
+    workdir = tempfile.mkdtemp(prefix='slackxkcd-bench-')
+    os.environ['COMIC_CACHE_DB'] = os.path.join(workdir, 'comics.db')
+    os.environ['HISTORY_LOG'] = os.path.join(workdir, 'history.log')
+    os.environ['SNAPSHOT_PATH'] = os.path.join(workdir, 'snapshot.json')
+    # so every reply gets its own token bucket
+    os.environ.setdefault('SLACK_CHANNEL_RATE', '1000')
+    # every command comes from the same user, who must not be shed
+    os.environ.setdefault('USER_RATE', '1000')
+    os.environ.setdefault('USER_BURST', '1000')
+    if ns.burst:
+        # room for the whole burst at once
+        os.environ.setdefault('XKCD_POOL_SIZE', str(ns.burst))
+        os.environ.setdefault('ADMIT_MAX_INFLIGHT', str(ns.burst + 2))
+        os.environ.setdefault('ADMIT_QUEUE', str(ns.burst))
+    if ns.batch:
+        os.environ.setdefault('MAX_BATCH', str(ns.batch))
+        os.environ.setdefault('XKCD_POOL_SIZE', str(ns.batch))
+        # so no comic is cached before it is asked for
+        os.environ.setdefault('COMIC_PREFETCH_WINDOW', '0')
+
+    from slack_client import SlackClient
+    bot = SlackClient('xoxb-bench', bot_id=BOT_ID, slack_api_url=api_url)
+    await asyncio.wait_for(slack.connected.wait(), 10)
+
+    if ns.burst:
+        result = await burst(ns, slack, bot)
+    elif ns.batch:
+        result = await batch(ns, slack, bot)
+    else:
+        result = await steady(ns, slack)
+    result['upstream'] = dict(bot.xkcd.stats(), xkcd_requests=xkcd.requests)
+
+    await bot.shutdown()
+    await bot.close()
+    await slack.stop()
+    await xkcd.stop()
+    return result
+
+
+def print_upstream(result):
+    upstream = result['upstream']
+    print(f"xkcd was asked {upstream['xkcd_requests']} times: "
+          f"{upstream['upstream_fetches']} comic fetches, "
+          f"{upstream['prefetched']} of them prefetches; "
+          f"{upstream['coalesced']} requests shared a fetch in flight "
+          "instead of making their own")
+
+
+def main(args):
+    ns = create_parser(args)
+    result = asyncio.get_event_loop().run_until_complete(run(ns))
+    if ns.json:
+        print(json.dumps(result, indent=2))
+    elif ns.burst:
+        print_burst(result)
+    elif ns.batch:
+        print_batch(result)
+    else:
+        print_report(result)
+    if not ns.json:
+        print_upstream(result)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""Load generator for the Events API mode.
+
+Starts a fake Slack Web API and a fake xkcd server, launches
+`slackxkcd.py --events` with the requested number of workers, posts
+signed app_mention events at it as fast as `--concurrency` allows and
+reports how many replies per second come back.  Run it from the
+repository root, once per worker count:
+
+    python bench/events_load.py --workers 1
+    python bench/events_load.py --workers 4
+
+With --redeliver every event is posted a second time as a Slack retry,
+which may reach another worker.  Each event must still be answered
+exactly once.
+
+    python bench/events_load.py --workers 4 --redeliver
+"""
+
+import os
+import sys
+import hmac
+import json
+import time
+import socket
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+# Guard against python2
+if sys.version_info[0] < 3:
+    raise RuntimeError("Python 3 is required")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import aiohttp  # noqa: E402
+from fake_servers import FakeSlack, FakeXkcd  # noqa: E402
+
+BOT_ID = 'UBOT'
+SECRET = 'bench-signing-secret'
+
+
+def create_parser(args):
+    parser = argparse.ArgumentParser(
+        description='Events API throughput against local fake servers')
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    parser.add_argument('-n', '--requests', type=int, default=2000)
+    parser.add_argument('-c', '--concurrency', type=int, default=64)
+    parser.add_argument('--command', default='help',
+                        help='Command text to mention the bot with')
+    parser.add_argument('--redeliver', action='store_true',
+                        help='Post every event twice, the second time as '
+                             'a retry')
+    return parser.parse_args(args)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def signed(body, retry=0):
+    timestamp = str(int(time.time()))
+    signature = 'v0=' + hmac.new(
+        SECRET.encode(), f'v0:{timestamp}:'.encode() + body,
+        hashlib.sha256).hexdigest()
+    headers = {'X-Slack-Request-Timestamp': timestamp,
+               'X-Slack-Signature': signature,
+               'Content-Type': 'application/json'}
+    if retry:
+        headers['X-Slack-Retry-Num'] = str(retry)
+        headers['X-Slack-Retry-Reason'] = 'http_timeout'
+    return headers
+
+
+def event(seq, command):
+    return json.dumps({
+        'type': 'event_callback',
+        'event_id': f'Ev{seq:08d}',
+        'event': {'type': 'app_mention', 'user': 'UHUMAN',
+                  'text': f'<@{BOT_ID}> {command}',
+                  'channel': f'C{seq:08d}', 'ts': f'{seq}.000100'},
+    }).encode()
+
+
+async def wait_for_port(port, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f'workers did not listen on {port}')
+
+
+async def run(ns):
+    slack, xkcd = FakeSlack(bot_id=BOT_ID), FakeXkcd(latency=0.05)
+    workdir = tempfile.mkdtemp(prefix='slackxkcd-events-')
+    port = free_port()
+    env = dict(os.environ,
+               SLACK_API_URL=await slack.start(),
+               XKCD_BASE_URL=await xkcd.start(),
+               BOT_USER_TOKEN='xoxb-bench', BOT_USER_ID=BOT_ID,
+               SLACK_SIGNING_SECRET=SECRET,
+               SLACK_CHANNEL_RATE='1000',
+               USER_RATE='100000', USER_BURST='100000',
+               ADMIT_QUEUE='100000',
+               COMIC_CACHE_DB=os.path.join(workdir, 'comics.db'),
+               STATE_DB=os.path.join(workdir, 'state.db'),
+               SNAPSHOT_PATH=os.path.join(workdir, 'snapshot.json'))
+    workers = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'slackxkcd.py'), '--events',
+         '--workers', str(ns.workers), '--port', str(port)],
+        cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        await wait_for_port(port)
+        replies = []
+        slack.on_post = lambda received, args: replies.append(received)
+        url = f'http://127.0.0.1:{port}/slack/events'
+        queue = asyncio.Queue()
+        deliveries = (0, 1) if ns.redeliver else (0,)
+        for retry in deliveries:
+            for seq in range(ns.requests):
+                queue.put_nowait((seq, retry))
+
+        async def client(session):
+            while not queue.empty():
+                seq, retry = queue.get_nowait()
+                body = event(seq, ns.command)
+                async with session.post(url, data=body,
+                                        headers=signed(body, retry)) as resp:
+                    await resp.read()
+
+        start = time.monotonic()
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(*[client(session)
+                                   for _ in range(ns.concurrency)])
+        acked = time.monotonic() - start
+        deadline = time.monotonic() + 30
+        while len(replies) < ns.requests and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        elapsed = max(replies, default=time.monotonic()) - start
+        print(f'workers {ns.workers}: {ns.requests} events acked in '
+              f'{acked:.2f}s ({ns.requests / acked:.0f}/s), '
+              f'{len(replies)} replies in {elapsed:.2f}s '
+              f'({len(replies) / elapsed:.0f}/s)')
+        if ns.redeliver:
+            # late replies to retries would show up here
+            await asyncio.sleep(1)
+            print(f'{ns.requests} events delivered twice, '
+                  f'{len(replies)} replies')
+            assert len(replies) == ns.requests, 'a retry was answered'
+    finally:
+        workers.terminate()
+        workers.wait()
+        await slack.stop()
+        await xkcd.stop()
+
+
+def main(args):
+    asyncio.get_event_loop().run_until_complete(run(create_parser(args)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""Local stand-ins for the Slack RTM/Web APIs and the xkcd JSON API,
+so the bot can be benchmarked without touching the network"""
+
+import sys
+import json
+import time
+import random
+import asyncio
+from itertools import accumulate
+from aiohttp import web
+
+# Guard against python2
+if sys.version_info[0] < 3:
+    raise RuntimeError("Python 3 is required")
+
+
+# made up words for alt texts and transcripts, the first ones the most
+# common, the way words are in real text
+SYLLABLES = ('ka', 'lo', 'mi', 'ne', 'ru', 'ta', 'vo', 'xi',
+             'be', 'do', 'fu', 'gi', 'ha', 'ju', 'pe', 'so')
+VOCABULARY = [a + b + c for a in SYLLABLES for b in SYLLABLES
+              for c in SYLLABLES]
+WORD_WEIGHTS = list(accumulate(1 / rank
+                               for rank in range(1, len(VOCABULARY) + 1)))
+
+
+def made_up_text(rng, count):
+    return ' '.join(rng.choices(VOCABULARY, cum_weights=WORD_WEIGHTS,
+                                k=count))
+
+
+class FakeXkcd:
+    """ Serves /{n}/info.0.json and the latest comic, after `latency`
+    seconds, for comics 1 to `last`.
+
+    Faults can be switched on and off while it runs: with `status` set
+    to a 5xx every request is answered with that error, and `hang`
+    seconds are added to every answer."""
+
+    def __init__(self, last=2500, latency=0.05, status=200, hang=0):
+        self.last = last
+        self.latency = latency
+        self.status = status
+        self.hang = hang
+        self.requests = 0
+        self.runner = None
+        self.url = None
+
+    def comic(self, num):
+        rng = random.Random(num)
+        return {
+            'num': num,
+            'title': f'Comic {num}',
+            'safe_title': f'Comic {num}',
+            'img': f'https://imgs.xkcd.com/comics/comic_{num}.png',
+            'alt': f'The alt text of comic {num} ' + made_up_text(rng, 20),
+            'transcript': (f'A transcript of comic number {num} ' +
+                           made_up_text(rng, 60)),
+        }
+
+    async def handle_comic(self, request):
+        self.requests += 1
+        num = int(request.match_info.get('num', self.last))
+        await asyncio.sleep(self.latency + self.hang)
+        if self.status != 200:
+            return web.Response(status=self.status)
+        if not 0 < num <= self.last or num == 404:
+            return web.Response(status=404)
+        return web.json_response(self.comic(num))
+
+    async def start(self, port=0):
+        app = web.Application()
+        app.router.add_get('/{num:\\d+}/info.0.json', self.handle_comic)
+        app.router.add_get('/info.0.json', self.handle_comic)
+        app.router.add_get('//info.0.json', self.handle_comic)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}/'
+        return self.url
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+class FakeSlack:
+    """ Speaks enough of Slack for the bot: auth.test, rtm.connect,
+    chat.postMessage, and an RTM websocket that says hello, forwards
+    the message events we send and says goodbye on request.
+
+    With `rate_limit_every` set, every so many chat.postMessage calls
+    are refused with a 429 asking to retry after `retry_after` seconds."""
+
+    def __init__(self, bot_id='UBOT', rate_limit_every=0, retry_after=1):
+        self.bot_id = bot_id
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.post_calls = 0
+        self.rate_limited = 0
+        self.sockets = []
+        self.connected = asyncio.Event()
+        self.posts = []
+        self.on_post = None
+        self.runner = None
+        self.url = None
+
+    async def handle_auth_test(self, request):
+        return web.json_response({'ok': True, 'user_id': self.bot_id})
+
+    async def handle_rtm_connect(self, request):
+        ws_url = self.url.replace('http://', 'ws://') + 'rtm'
+        return web.json_response({
+            'ok': True, 'url': ws_url,
+            'self': {'id': self.bot_id, 'name': 'bench-bot'},
+            'team': {'id': 'TBENCH', 'domain': 'bench', 'name': 'Bench'},
+        })
+
+    async def handle_post_message(self, request):
+        received = time.monotonic()
+        self.post_calls += 1
+        if (self.rate_limit_every and
+                self.post_calls % self.rate_limit_every == 0):
+            self.rate_limited += 1
+            return web.json_response(
+                {'ok': False, 'error': 'ratelimited'}, status=429,
+                headers={'Retry-After': str(self.retry_after)})
+        if request.content_type == 'application/json':
+            args = await request.json()
+        else:
+            args = dict(await request.post())
+        self.posts.append((received, args))
+        if self.on_post is not None:
+            self.on_post(received, args)
+        return web.json_response({'ok': True, 'channel': args.get('channel'),
+                                  'ts': f'{received:.6f}'})
+
+    async def handle_rtm(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.append(ws)
+        await ws.send_str(json.dumps({'type': 'hello'}))
+        self.connected.set()
+        async for _ in ws:
+            # the bot only sends pings
+            pass
+        self.sockets.remove(ws)
+        return ws
+
+    async def send_event(self, event):
+        """ Sends an RTM event to every connected bot"""
+        data = json.dumps(event)
+        for ws in self.sockets:
+            await ws.send_str(data)
+
+    async def send_goodbye(self):
+        """ Says goodbye and closes every RTM connection, the way Slack
+        does before it moves a bot to another server.  A bot that
+        handles this reconnects."""
+        self.connected.clear()
+        await self.send_event({'type': 'goodbye'})
+        for ws in list(self.sockets):
+            await ws.close()
+
+    async def send_message(self, text, channel, user='UHUMAN', ts=None):
+        await self.send_event({
+            'type': 'message', 'channel': channel, 'user': user,
+            'text': text, 'ts': ts or f'{time.time():.6f}',
+        })
+
+    async def start(self, port=0):
+        app = web.Application()
+        app.router.add_route('*', '/api/auth.test', self.handle_auth_test)
+        app.router.add_route('*', '/api/rtm.connect', self.handle_rtm_connect)
+        app.router.add_route('*', '/api/chat.postMessage',
+                             self.handle_post_message)
+        app.router.add_get('/rtm', self.handle_rtm)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}/'
+        return self.url + 'api/'
+
+    async def stop(self):
+        for ws in list(self.sockets):
+            await ws.close()
+        await self.runner.cleanup()
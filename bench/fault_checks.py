@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""Checks that the bot copes with misbehaving upstreams, using the
+fake servers.  Each check prints what happened and fails loudly if the
+bot did not cope.  Run it from the repository root:
+
+    python bench/fault_checks.py
+    python bench/fault_checks.py slack_goodbye xkcd_budget
+"""
+
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import asyncio
+import tempfile
+
+# Guard against python2
+if sys.version_info[0] < 3:
+    raise RuntimeError("Python 3 is required")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_servers import FakeSlack, FakeXkcd  # noqa: E402
+
+BOT_ID = 'UBOT'
+
+
+async def check_slack_429():
+    """ Every 4th chat.postMessage is refused with a 429.  Every
+    message must still be delivered, the refused ones after waiting
+    out Retry-After."""
+    from slack import WebClient
+    from outbound import OutboundQueue
+    slack = FakeSlack(rate_limit_every=4, retry_after=1)
+    api_url = await slack.start()
+    client = WebClient(token='xoxb-check', run_async=True, base_url=api_url)
+
+    async def send(chan, blocks):
+        await client.chat_postMessage(channel=chan, blocks=blocks)
+    outbound = OutboundQueue(send, workers=3, rate=1000, burst=1000)
+    start = time.monotonic()
+    for n in range(12):
+        await outbound.put(f'C{n % 3}', '[]')
+    await outbound.join()
+    elapsed = time.monotonic() - start
+    paused = outbound.resume_at - start
+    stats = outbound.stats()
+    await outbound.stop()
+    await slack.stop()
+    print(f'slack_429: 12 messages, {slack.rate_limited} refused, '
+          f'delivered in {elapsed:.2f}s, senders paused until '
+          f'{paused:.2f}s, stats {stats}')
+    assert stats['sent'] == 12 and stats['failed'] == 0, stats
+    assert stats['retries'] == slack.rate_limited > 0, stats
+    assert stats['throttled'] >= stats['retries'], stats
+    assert paused > 0, 'no Retry-After pause was recorded'
+    assert elapsed >= slack.retry_after, 'Retry-After was not waited out'
+
+
+async def xkcd_api(xkcd, workdir):
+    """ Starts the fake xkcd and returns an AsyncXkcdApi using it,
+    with its comic cache in workdir"""
+    from xkcd import AsyncXkcdApi
+    from comic_cache import ComicCache
+    os.environ['XKCD_BASE_URL'] = await xkcd.start()
+    return AsyncXkcdApi(
+        cache=ComicCache(db_path=os.path.join(workdir, 'comics.db')))
+
+
+async def ask(slack, command, channel='CFAULT'):
+    """ Mentions the bot with a command, returns how long the reply
+    took and its chat.postMessage arguments"""
+    sent = time.monotonic()
+    await slack.send_message(f'<@{BOT_ID}> {command}', channel)
+    deadline = sent + 10
+    while time.monotonic() < deadline:
+        for received, args in slack.posts:
+            if received >= sent and args.get('channel') == channel:
+                return received - sent, args
+        await asyncio.sleep(0.01)
+    raise AssertionError(f'no reply to {command}')
+
+
+async def check_slack_goodbye():
+    """ Slack says goodbye and closes the RTM connection.  The bot must
+    say goodbye, reconnect and keep answering commands."""
+    from slack_client import SlackClient
+    workdir = tempfile.mkdtemp(prefix='slackxkcd-faults-')
+    xkcd = FakeXkcd(latency=0)
+    slack = FakeSlack(bot_id=BOT_ID)
+    os.environ['XKCD_BASE_URL'] = await xkcd.start()
+    os.environ.update(
+        COMIC_CACHE_DB=os.path.join(workdir, 'comics.db'),
+        HISTORY_LOG=os.path.join(workdir, 'history.log'),
+        SNAPSHOT_PATH=os.path.join(workdir, 'snapshot.json'))
+    api_url = await slack.start()
+    bot = SlackClient('xoxb-check', bot_id=BOT_ID, slack_api_url=api_url)
+    await asyncio.wait_for(slack.connected.wait(), 10)
+    await ask(slack, 'ping')
+    start = time.monotonic()
+    await slack.send_goodbye()
+    await asyncio.wait_for(slack.connected.wait(), 10)
+    reconnected = time.monotonic() - start
+    waited, args = await ask(slack, 'ping')
+    goodbyes = [args for _, args in slack.posts
+                if 'Goodbye' in str(args.get('blocks'))]
+    await bot.shutdown()
+    await bot.close()
+    await slack.stop()
+    await xkcd.stop()
+    shutil.rmtree(workdir)
+    print(f'slack_goodbye: reconnected {reconnected * 1000:.0f} ms after '
+          f'goodbye, answered ping {waited * 1000:.1f} ms after that')
+    assert goodbyes, 'the bot did not say goodbye'
+    assert 'has been running' in str(args.get('blocks')), args
+
+
+async def check_shared_db_locked():
+    """ Another worker holds the write lock of the shared comic store
+    and state database.  The bot must keep answering while its own
+    writes wait, and write them once the lock is released."""
+    from slack_client import SlackClient
+    from history import SqliteHistory
+    workdir = tempfile.mkdtemp(prefix='slackxkcd-faults-')
+    state_db = os.path.join(workdir, 'state.db')
+    comics_db = os.path.join(workdir, 'comics.db')
+    xkcd = FakeXkcd(latency=0)
+    slack = FakeSlack(bot_id=BOT_ID)
+    os.environ['XKCD_BASE_URL'] = await xkcd.start()
+    os.environ.update(
+        COMIC_CACHE_DB=comics_db,
+        SNAPSHOT_PATH=os.path.join(workdir, 'snapshot.json'))
+    api_url = await slack.start()
+    bot = SlackClient('xoxb-check', bot_id=BOT_ID, slack_api_url=api_url,
+                      history=SqliteHistory(state_db))
+    await asyncio.wait_for(slack.connected.wait(), 10)
+    await ask(slack, 'last')
+    held = 2.0
+    holders = [sqlite3.connect(path) for path in (comics_db, state_db)]
+    for holder in holders:
+        holder.execute('BEGIN IMMEDIATE')
+    comic_waited, _ = await ask(slack, '7')
+    ping_waited, _ = await ask(slack, 'ping')
+    await asyncio.sleep(held)
+    for holder in holders:
+        holder.rollback()
+        holder.close()
+    await bot.shutdown()
+    await bot.close()
+    await slack.stop()
+    await xkcd.stop()
+    with sqlite3.connect(state_db) as db:
+        stored = db.execute('SELECT num FROM history WHERE channel = ?',
+                            ('CFAULT',)).fetchall()
+    with sqlite3.connect(comics_db) as db:
+        cached = db.execute('SELECT 1 FROM comics WHERE num = 7').fetchone()
+    shutil.rmtree(workdir)
+    print(f'shared_db_locked: with the write lock held for {held}s, a '
+          f'comic was answered in {comic_waited * 1000:.1f} ms and ping in '
+          f'{ping_waited * 1000:.1f} ms; afterwards history {stored}')
+    assert comic_waited < 0.5 and ping_waited < 0.5, \
+        'the loop waited for the write lock'
+    assert (7,) in stored, 'the history append was lost'
+    assert cached, 'the comic was not stored'
+
+
+async def check_xkcd_5xx():
+    """ xkcd answers every request with a 503.  Each fetch must be
+    retried, and after `threshold` failed fetches the circuit breaker
+    must open and fail the next fetch at once, without asking xkcd."""
+    from resilience import CircuitOpenError, UpstreamUnavailable
+    workdir = tempfile.mkdtemp(prefix='slackxkcd-faults-')
+    xkcd = FakeXkcd(status=503, latency=0)
+    api = await xkcd_api(xkcd, workdir)
+    threshold = api.breaker.threshold
+    for n in range(threshold):
+        try:
+            await api.get_comic(n + 1)
+        except CircuitOpenError:
+            raise AssertionError(f'the circuit opened after {n} fetches')
+        except UpstreamUnavailable:
+            pass
+    asked = xkcd.requests
+    start = time.monotonic()
+    try:
+        await api.get_comic(threshold + 1)
+    except CircuitOpenError:
+        pass
+    else:
+        raise AssertionError('the circuit did not open')
+    failed_fast = time.monotonic() - start
+    await api.close()
+    await xkcd.stop()
+    shutil.rmtree(workdir)
+    print(f'xkcd_5xx: {threshold} fetches made {asked} requests, then the '
+          f'circuit was {api.breaker.state} and failed the next fetch in '
+          f'{failed_fast * 1000:.1f} ms')
+    assert asked > threshold, 'failed fetches were not retried'
+    assert xkcd.requests == asked, 'the open circuit still asked xkcd'
+    assert failed_fast < 0.1, 'the open circuit did not fail fast'
+
+
+async def check_xkcd_budget():
+    """ xkcd takes twice the command budget to answer.  The bot must
+    reply that xkcd is not answering once the budget is spent, instead
+    of waiting for it."""
+    from slack_client import SlackClient
+    workdir = tempfile.mkdtemp(prefix='slackxkcd-faults-')
+    xkcd = FakeXkcd(latency=0)
+    slack = FakeSlack(bot_id=BOT_ID)
+    os.environ['XKCD_BASE_URL'] = await xkcd.start()
+    os.environ.update(
+        COMMAND_BUDGET='0.5',
+        COMIC_CACHE_DB=os.path.join(workdir, 'comics.db'),
+        HISTORY_LOG=os.path.join(workdir, 'history.log'),
+        SNAPSHOT_PATH=os.path.join(workdir, 'snapshot.json'))
+    api_url = await slack.start()
+    bot = SlackClient('xoxb-check', bot_id=BOT_ID, slack_api_url=api_url)
+    await asyncio.wait_for(slack.connected.wait(), 10)
+    # learn the latest comic while xkcd is still healthy
+    await ask(slack, 'last')
+    xkcd.hang = 1.0
+    waited, args = await ask(slack, '7')
+    await bot.shutdown()
+    await bot.close()
+    await slack.stop()
+    await xkcd.stop()
+    shutil.rmtree(workdir)
+    del os.environ['COMMAND_BUDGET']
+    print(f'xkcd_budget: xkcd hung for {xkcd.hang}s, the bot replied '
+          f'after {waited:.2f}s')
+    assert 'not answering' in str(args.get('blocks')), args
+    assert waited < xkcd.hang, 'the bot waited for xkcd past its budget'
+
+
+async def check_xkcd_late_answer():
+    """ xkcd answers after the command budget is spent.  The fetch must
+    carry on in the background and fill the cache, so asking again is
+    answered without going back to xkcd."""
+    from resilience import UpstreamUnavailable
+    workdir = tempfile.mkdtemp(prefix='slackxkcd-faults-')
+    os.environ['COMMAND_BUDGET'] = '0.5'
+    xkcd = FakeXkcd(latency=0, hang=1.0)
+    api = await xkcd_api(xkcd, workdir)
+    del os.environ['COMMAND_BUDGET']
+    try:
+        await api.get_comic(7)
+    except UpstreamUnavailable:
+        pass
+    else:
+        raise AssertionError('xkcd answered within the budget')
+    cached_early = 7 in api.cache
+    await asyncio.sleep(xkcd.hang)
+    start = time.monotonic()
+    comic_object = await api.get_comic(7)
+    elapsed = time.monotonic() - start
+    await api.close()
+    await xkcd.stop()
+    shutil.rmtree(workdir)
+    print(f'xkcd_late_answer: the late answer was cached, asking again '
+          f'took {elapsed * 1000:.1f} ms and {xkcd.requests} request in all')
+    assert not cached_early, 'the comic was cached before xkcd answered'
+    assert comic_object['num'] == 7, comic_object
+    assert xkcd.requests == 1, 'the late answer was not cached'
+
+
+CHECKS = {
+    'slack_429': check_slack_429,
+    'slack_goodbye': check_slack_goodbye,
+    'shared_db_locked': check_shared_db_locked,
+    'xkcd_5xx': check_xkcd_5xx,
+    'xkcd_budget': check_xkcd_budget,
+    'xkcd_late_answer': check_xkcd_late_answer,
+}
+
+
+def main(args):
+    selected = args or list(CHECKS)
+    for name in selected:
+        asyncio.run(CHECKS[name]())
+    print(f'{len(selected)} checks passed')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
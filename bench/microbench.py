@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks of per-message costs on the bot's hot path.
+Run it from the repository root:
+
+    python bench/microbench.py
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import timeit
+import tempfile
+import tracemalloc
+
+# Guard against python2
+if sys.version_info[0] < 3:
+    raise RuntimeError("Python 3 is required")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rendering  # noqa: E402
+from metrics import Metrics  # noqa: E402
+from ingest import IngestFilter  # noqa: E402
+from comic_cache import ComicCache  # noqa: E402
+from mirror import SearchIndex  # noqa: E402
+from history import ChannelHistory  # noqa: E402
+from fake_servers import FakeXkcd  # noqa: E402
+
+COMIC = {
+    'num': 1481,
+    'title': 'API',
+    'img': 'https://imgs.xkcd.com/comics/api.png',
+    'alt': 'ACCESS LIMITS: Clients may maintain connections to the server '
+           'for no more than 86,400 seconds per day.',
+}
+
+
+def bench_rendering():
+    renderer = rendering.BlockRenderer()
+    renderer.add_static('help', 'Available commands: \n' + 'x' * 600)
+    return {
+        'comic json.dumps': lambda: rendering.comic_to_blocks(COMIC),
+        'comic pre-rendered': lambda: renderer.comic(COMIC),
+        'help json.dumps': lambda: rendering.text_to_blocks(
+            'Available commands: \n' + 'x' * 600),
+        'help pre-rendered': lambda: renderer.static('help'),
+    }
+
+
+def bench_metrics():
+    metrics = Metrics()
+    return {
+        'metrics observe': lambda: metrics.observe('handle', '[int]', 0.004),
+        'metrics 5 stages': lambda: [
+            metrics.observe(stage, '[int]', 0.004)
+            for stage in ('parse', 'handle', 'queue', 'total', 'fetch')],
+    }
+
+
+def channel_stream(size=1000, bot_id='UBOT'):
+    """ A busy channel: 1 message in 20 mentions the bot, some are
+    joins, edits and other bots, and 1 in 100 is delivered twice"""
+    rng = random.Random(0)
+    chatter = ('did anyone look at the deploy from this morning, it seems '
+               'slower than usual and the dashboards are all red again')
+    stream = []
+    for seq in range(size):
+        data = {'channel': f'C{seq % 7}', 'ts': f'{seq}.000100',
+                'user': 'UHUMAN', 'text': chatter[:rng.randint(20, 120)]}
+        roll = rng.random()
+        if roll < 0.06:
+            data['text'] = f'<@{bot_id}> {rng.randint(1, 2000)}'
+        if 0.05 < roll < 0.10:
+            # including another bot relaying a mention
+            data['subtype'] = rng.choice(
+                ['bot_message', 'message_changed', 'channel_join'])
+        stream.append(data)
+        if roll < 0.01:
+            stream.append(dict(data))
+    return stream
+
+
+def unfiltered_ingest(data, at_bot='<@UBOT>'):
+    """ How on_message used to look at a message"""
+    if 'text' in data and at_bot in data['text']:
+        raw_command = data['text'].split(at_bot)[1]
+        cmd = raw_command.strip().lower().split()[0]
+        try:
+            cmd = int(cmd)
+        except Exception:
+            pass
+        return cmd, raw_command.split()[1:]
+
+
+def bench_ingest():
+    stream = channel_stream()
+
+    def filtered():
+        accept = IngestFilter('UBOT').accept
+        return [accept(data) for data in stream]
+
+    def unfiltered():
+        return [unfiltered_ingest(data) for data in stream]
+    print(f'of {len(stream)} messages, '
+          f'{len(list(filter(None, unfiltered())))} were dispatched '
+          f'unfiltered, {len(list(filter(None, filtered())))} filtered')
+    return {
+        'ingest 1000 unfiltered': unfiltered,
+        'ingest 1000 filtered': filtered,
+    }
+
+
+def bench_search(comics=3000):
+    """ Builds the search index over a mirror of `comics` fake comics
+    with alt texts and transcripts, and reports how long that took,
+    which the bot now does in a thread at startup"""
+    workdir = tempfile.mkdtemp(prefix='slackxkcd-search-')
+    db_path = os.path.join(workdir, 'comics.db')
+    xkcd = FakeXkcd(last=comics)
+    cache = ComicCache(db_path=db_path)
+    for num in range(1, comics + 1):
+        cache.put(num, xkcd.comic(num))
+    cache.flush()
+    start = time.perf_counter()
+    index = SearchIndex.from_cache(cache)
+    built = time.perf_counter() - start
+    print(f'indexed {len(index)} comics, {len(index.postings)} terms, '
+          f'in {built * 1000:.0f} ms from a '
+          f'{os.path.getsize(db_path) / 1e6:.1f} MB comics.db')
+    shutil.rmtree(workdir)
+    return {
+        'search title word': lambda: index.search('comic'),
+        'search common word': lambda: index.search('kakaka'),
+        'search rare word': lambda: index.search('sososo'),
+        'search no match': lambda: index.search('nothing here'),
+    }
+
+
+def bench_history(channels=1000, bytes_per_channel=400):
+    """ Fills the history of `channels` channels and checks that a
+    channel costs no more memory than ChannelHistory documents"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    history = ChannelHistory(path=None, max_channels=channels)
+    for n in range(channels):
+        channel = f'C{n:08d}'
+        for comic_number in range(history.size + 10):
+            history.append(channel, comic_number + 1)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f'history of {channels} full channels takes {used / 1e3:.0f} KB, '
+          f'{used / channels:.0f} bytes per channel')
+    assert used / channels < bytes_per_channel, \
+        f'a channel costs more than {bytes_per_channel} bytes'
+    return {
+        'history append': lambda: history.append('C00000007', 1481),
+        'history last': lambda: history.last('C00000007'),
+        'history get': lambda: history.get('C00000007'),
+    }
+
+
+def main(args):
+    cases = {}
+    cases.update(bench_rendering())
+    cases.update(bench_metrics())
+    cases.update(bench_ingest())
+    cases.update(bench_history())
+    if not args or any('search' in arg for arg in args):
+        cases.update(bench_search())
+    selected = [name for name in cases
+                if not args or any(arg in name for arg in args)]
+    for name in selected:
+        timer = timeit.Timer(cases[name])
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat=5, number=number)) / number
+        print(f'{name:<24} {best * 1e6:8.3f} us')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
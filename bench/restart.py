@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""How soon a restarted bot answers.
+
+Runs the bot against local fake servers, shows a few comics and shuts it
+down gracefully, which saves a snapshot.  Then it starts the bot twice
+more: cold, without the snapshot, and warm, with it.  For each start it
+reports how long after the bot was created the first replies to `last`
+and to a comic shown before arrived, and how long those took once
+connected.  Run it from the repository root:
+
+    python bench/restart.py
+"""
+
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+
+# Guard against python2
+if sys.version_info[0] < 3:
+    raise RuntimeError("Python 3 is required")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_servers import FakeSlack, FakeXkcd  # noqa: E402
+
+BOT_ID = 'UBOT'
+
+
+def create_parser(args):
+    parser = argparse.ArgumentParser(
+        description='Time to first reply after a cold and a warm restart')
+    parser.add_argument('--xkcd-latency', type=float, default=0.2,
+                        help='Seconds the fake xkcd takes to answer')
+    parser.add_argument('--comics', type=int, default=20,
+                        help='Comics shown before the restart')
+    return parser.parse_args(args)
+
+
+async def start_bot(slack, api_url):
+    from slack_client import SlackClient
+    slack.connected.clear()
+    created = time.monotonic()
+    bot = SlackClient('xoxb-bench', bot_id=BOT_ID, slack_api_url=api_url)
+    await asyncio.wait_for(slack.connected.wait(), 10)
+    return bot, created
+
+
+async def ask(slack, commands, prefix):
+    """ Sends each command in its own channel, returns when
+    each was sent and when its reply arrived"""
+    sent, replies = {}, {}
+
+    def on_post(received, args):
+        replies.setdefault(args.get('channel'), received)
+    slack.on_post = on_post
+    for n, command in enumerate(commands):
+        channel = f'{prefix}{n}'
+        sent[channel] = (command, time.monotonic())
+        await slack.send_message(f'<@{BOT_ID}> {command}', channel)
+    deadline = time.monotonic() + 10
+    while len(replies) < len(sent) and time.monotonic() < deadline:
+        await asyncio.sleep(0.001)
+    return {command: (sent_at, replies.get(channel))
+            for channel, (command, sent_at) in sent.items()}
+
+
+async def stop_bot(bot):
+    await bot.shutdown()
+    await bot.close()
+
+
+async def run(ns):
+    xkcd = FakeXkcd(latency=ns.xkcd_latency)
+    slack = FakeSlack(bot_id=BOT_ID)
+    os.environ['XKCD_BASE_URL'] = await xkcd.start()
+    api_url = await slack.start()
+    workdir = tempfile.mkdtemp(prefix='slackxkcd-restart-')
+    snapshot = os.path.join(workdir, 'snapshot.json')
+    os.environ.update(
+        COMIC_CACHE_DB=os.path.join(workdir, 'comics.db'),
+        HISTORY_LOG=os.path.join(workdir, 'history.log'),
+        SNAPSHOT_PATH=snapshot,
+        SLACK_CHANNEL_RATE='1000', USER_RATE='1000', USER_BURST='1000')
+
+    bot, _ = await start_bot(slack, api_url)
+    await ask(slack, ['last'] + [str(n) for n in range(1, ns.comics + 1)],
+              'W')
+    await stop_bot(bot)
+    shutil.copy(snapshot, snapshot + '.saved')
+
+    commands = ['last', str(ns.comics // 2)]
+    for start in ('cold', 'warm'):
+        if start == 'cold':
+            os.remove(snapshot)
+        else:
+            shutil.copy(snapshot + '.saved', snapshot)
+        bot, created = await start_bot(slack, api_url)
+        answered = await ask(slack, commands, start[0].upper())
+        await stop_bot(bot)
+        for command, (sent_at, replied_at) in answered.items():
+            if replied_at is None:
+                print(f'{start} {command:<6} no reply')
+                continue
+            print(f'{start} {command:<6} reply '
+                  f'{(replied_at - created) * 1000:7.1f} ms after start, '
+                  f'{(replied_at - sent_at) * 1000:6.1f} ms after asking')
+
+    await slack.stop()
+    await xkcd.stop()
+    shutil.rmtree(workdir)
+
+
+def main(args):
+    asyncio.get_event_loop().run_until_complete(run(create_parser(args)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
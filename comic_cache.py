@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""A two tier cache of xkcd comic metadata: an in-memory LRU
+sitting in front of a persistent sqlite store."""
+
+import sys
+import json
+import sqlite3
+import logging
+from collections import OrderedDict
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+# Guard against python2
+if sys.version_info[0] < 3:
+    raise RuntimeError("Python 3 is required")
+
+logger = logging.getLogger(__name__)
+
+
+class ComicCache:
+    """ Caches comic metadata by comic number.  Published comics never
+    change, so entries are never expired - only evicted from memory
+    when the LRU is full.  Evicted entries remain on disk.
+
+    Disk writes are made by a writer thread with its own connection.
+    The store may be shared by several worker processes, and sqlite
+    lets one write at a time: a put waiting its turn must not stall
+    the event loop."""
+
+    def __init__(self, max_size=256, db_path='comics.db'):
+        self.max_size = max_size
+        self.db_path = db_path
+        self._lru = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.listeners = []
+        # the store may be shared by several worker processes
+        self._db = sqlite3.connect(db_path, check_same_thread=False,
+                                   timeout=10)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS comics '
+            '(num INTEGER PRIMARY KEY, data TEXT NOT NULL)')
+        self._db.commit()
+        self._write_db = sqlite3.connect(db_path, check_same_thread=False,
+                                         timeout=10)
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='comics-db')
+
+    def __len__(self):
+        return len(self._lru)
+
+    def __contains__(self, num):
+        with self._lock:
+            if num in self._lru:
+                return True
+            row = self._db.execute(
+                'SELECT 1 FROM comics WHERE num = ?', (num,)).fetchone()
+        return row is not None
+
+    def __repr__(self):
+        return (f'ComicCache(size={len(self)}/{self.max_size}, '
+                f'db={self.db_path!r})')
+
+    def get(self, num):
+        """ Returns the cached comic object for a comic number,
+        or None if we have never seen it."""
+        with self._lock:
+            comic = self._lru.get(num)
+            if comic is not None:
+                self._lru.move_to_end(num)
+                self.hits += 1
+                return comic
+            row = self._db.execute(
+                'SELECT data FROM comics WHERE num = ?', (num,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            comic = json.loads(row[0])
+            self._remember(num, comic)
+            return comic
+
+    def put(self, num, comic):
+        """ Stores a comic object in memory at once, and queues it
+        to be written to disk."""
+        with self._lock:
+            self._remember(num, comic)
+        self._writer.submit(
+            self._write, num, json.dumps(comic, separators=(',', ':')))
+        for listener in self.listeners:
+            listener(comic)
+
+    def _write(self, num, data):
+        """ Writes a comic to disk, in the writer thread"""
+        try:
+            self._write_db.execute(
+                'INSERT OR REPLACE INTO comics (num, data) VALUES (?, ?)',
+                (num, data))
+            self._write_db.commit()
+        except sqlite3.Error:
+            logger.exception(f'Could not store comic {num}')
+
+    def flush(self):
+        """ Waits until every queued write is on disk"""
+        self._writer.submit(int).result()
+
+    def numbers(self):
+        """ Returns the set of comic numbers in the on-disk store"""
+        self.flush()
+        with self._lock:
+            rows = self._db.execute('SELECT num FROM comics').fetchall()
+        return {num for num, in rows}
+
+    def all_comics(self):
+        """ Returns every comic object in the on-disk store"""
+        self.flush()
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT data FROM comics ORDER BY num').fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def hot(self):
+        """ Returns the comic numbers held in memory, coldest first"""
+        with self._lock:
+            return list(self._lru)
+
+    def warm(self, numbers):
+        """ Loads comics from disk into memory, coldest first, without
+        counting them as hits or misses.  Returns the comics loaded."""
+        comics = []
+        with self._lock:
+            for num in numbers[-self.max_size:]:
+                row = self._db.execute(
+                    'SELECT data FROM comics WHERE num = ?',
+                    (num,)).fetchone()
+                if row is not None:
+                    comic = json.loads(row[0])
+                    self._remember(num, comic)
+                    comics.append(comic)
+        return comics
+
+    def _remember(self, num, comic):
+        """ Puts a comic at the hot end of the LRU, evicting
+        the coldest entries if we are over capacity.
+        Caller must hold the lock."""
+        self._lru[num] = comic
+        self._lru.move_to_end(num)
+        while len(self._lru) > self.max_size:
+            evicted, _ = self._lru.popitem(last=False)
+            self.evictions += 1
+            logger.debug(f'Evicted comic {evicted} from memory cache')
+
+    def stats(self):
+        """ Returns the cache counters, for sizing the cache."""
+        with self._lock:
+            on_disk = self._db.execute(
+                'SELECT COUNT(*) FROM comics').fetchone()[0]
+            return {
+                'size': len(self._lru),
+                'max_size': self.max_size,
+                'on_disk': on_disk,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def close(self):
+        """ Writes out queued comics and closes the on-disk store."""
+        self._writer.shutdown(wait=True)
+        self._write_db.close()
+        with self._lock:
+            self._db.close()
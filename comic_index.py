@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""A bitmap of the comic numbers xkcd can actually serve."""
+
+import sys
+import random
+import logging
+
+# Guard against python2
+if sys.version_info[0] < 3:
+    raise RuntimeError("Python 3 is required")
+
+logger = logging.getLogger(__name__)
+
+# 404 was never published, and 1663 is an interactive comic
+# with no image to show
+KNOWN_MISSING = (404, 1663)
+
+
+class ComicIndex:
+    """ One bit per comic number, set when the comic can be shown.
+    Numbers 1 through `last` start valid, apart from KNOWN_MISSING,
+    and the index grows whenever a newer comic is published.  Comics
+    xkcd answers 404 for are dropped as they are found.
+
+    Membership is a bit test, and random picks are a few bit tests,
+    since almost every number is valid."""
+
+    def __init__(self, missing=KNOWN_MISSING):
+        self.bits = bytearray(1)
+        self.last = 0
+        self.count = 0
+        self.missing = set(missing)
+
+    def __contains__(self, comic_number):
+        return (isinstance(comic_number, int) and
+                0 < comic_number <= self.last and
+                bool(self.bits[comic_number >> 3] & (1 << (comic_number & 7))))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (n for n in range(1, self.last + 1) if n in self)
+
+    def extend(self, last):
+        """ Marks every comic up to `last` as valid"""
+        if last <= self.last:
+            return
+        self.bits.extend(bytes((last >> 3) + 1 - len(self.bits)))
+        for comic_number in range(self.last + 1, last + 1):
+            if comic_number not in self.missing:
+                self.bits[comic_number >> 3] |= 1 << (comic_number & 7)
+                self.count += 1
+        self.last = last
+
+    def discard(self, comic_number):
+        """ Marks a comic as one xkcd cannot serve"""
+        self.missing.add(comic_number)
+        if comic_number in self:
+            self.bits[comic_number >> 3] &= ~(1 << (comic_number & 7))
+            self.count -= 1
+            logger.info(f'Comic {comic_number} is missing from xkcd')
+
+    def random(self, exclude=()):
+        """ Returns a random valid comic number not in exclude,
+        or None if there is none"""
+        if self.count <= len(exclude):
+            # maybe nothing left to pick, look at every comic
+            choices = [n for n in self if n not in exclude]
+            return random.choice(choices) if choices else None
+        while True:
+            comic_number = random.randint(1, self.last)
+            if comic_number in self and comic_number not in exclude:
+                return comic_number
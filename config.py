@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""Bot configuration, read from the environment and the .env file.
+Nothing is loaded at import time: the .env file is read once, on the
+first lookup."""
+
+import os
+import sys
+
+# Guard against python2
+if sys.version_info[0] < 3:
+    raise RuntimeError("Python 3 is required")
+
+_loaded = False
+
+
+def load():
+    """ Reads the .env file into the environment, once"""
+    global _loaded
+    if not _loaded:
+        from dotenv import load_dotenv
+        load_dotenv()
+        _loaded = True
+
+
+def get(name, default=None, cast=str):
+    """ Returns a setting, converted by cast, or the default if unset"""
+    load()
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return cast(value)
+
+
+def require(name):
+    """ Returns a setting that must be set"""
+    load()
+    return os.environ[name]
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""Receives Slack Events API callbacks over HTTP, as an alternative to the
+RTM websocket.  Workers are stateless: any number of worker processes can
+listen on the same port, sharing the comic cache and comic history
+through sqlite files on the local disk."""
+
+import sys
+import hmac
+import json
+import time
+import asyncio
+import signal
+import hashlib
+import logging
+import multiprocessing
+
+import config
+from log_setup import setup_logging
+
+# Guard against python2
+if sys.version_info[0] < 3:
+    raise RuntimeError("Python 3 is required")
+
+logger = logging.getLogger(__name__)
+
+# Slack rejects replays older than this, and so do we
+MAX_REQUEST_AGE = 60 * 5
+
+
+def verify_signature(signing_secret, timestamp, body, signature, now=None):
+    """ Checks the X-Slack-Signature of a request body"""
+    try:
+        age = abs((now or time.time()) - int(timestamp))
+    except (TypeError, ValueError):
+        return False
+    if age > MAX_REQUEST_AGE:
+        return False
+    basestring = b'v0:' + timestamp.encode() + b':' + body
+    expected = 'v0=' + hmac.new(signing_secret.encode(), basestring,
+                                hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or '')
+
+
+class EventsServer:
+    """ An HTTP endpoint for Slack's Events API.  Mentions of the bot
+    (app_mention events) are handed to the same SlackClient handlers
+    the RTM mode uses.  Slack wants an answer within three seconds, so
+    every event is acknowledged at once and handled in the background.
+    Slack still retries an event when an acknowledgement is late, and
+    a retry may reach another worker: with a shared `dedupe` store,
+    an event any worker has taken is dropped."""
+
+    def __init__(self, bot, signing_secret, path='/slack/events',
+                 dedupe=None):
+        self.bot = bot
+        self.signing_secret = signing_secret
+        self.path = path
+        self.dedupe = dedupe
+        self.dispatching = set()
+        self.runner = None
+
+    async def handle(self, request):
+        from aiohttp import web
+        body = await request.read()
+        if not verify_signature(
+                self.signing_secret,
+                request.headers.get('X-Slack-Request-Timestamp'),
+                body,
+                request.headers.get('X-Slack-Signature')):
+            logger.warning('Rejected a request with a bad signature')
+            return web.Response(status=401)
+        payload = json.loads(body)
+        if payload.get('type') == 'url_verification':
+            return web.json_response({'challenge': payload['challenge']})
+        if payload.get('type') == 'event_callback':
+            event = payload.get('event', {})
+            retry = request.headers.get('X-Slack-Retry-Num')
+            if retry is not None:
+                logger.info(f'Slack retry {retry} of event '
+                            f'{payload.get("event_id")}: '
+                            f'{request.headers.get("X-Slack-Retry-Reason")}')
+            if event.get('type') == 'app_mention':
+                task = asyncio.ensure_future(self.dispatch(event))
+                self.dispatching.add(task)
+                task.add_done_callback(self.dispatching.discard)
+        return web.Response()
+
+    async def dispatch(self, event):
+        """ Hands a mention to the bot, unless another worker took it"""
+        key = (event.get('channel'), event.get('ts'))
+        if (self.dedupe is not None and key[1] is not None and
+                not await self.dedupe.claim(key)):
+            self.bot.ingest.duplicates += 1
+            logger.debug(f'Dropped message {key}, taken by another worker')
+            return
+        await self.bot.on_message(data=event)
+
+    async def start(self, host='0.0.0.0', port=3000, reuse_port=False):
+        from aiohttp import web
+        await self.bot.ensure_bot_id()
+        self.bot.start_indexing()
+        await self.bot.start_metrics()
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port,
+                          reuse_port=reuse_port).start()
+        logger.info(f'Listening for Slack events on {host}:{port}'
+                    f'{self.path}')
+
+    async def stop(self):
+        """ Stops taking events, and hands the ones already taken
+        to the bot"""
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+        if self.dispatching:
+            await asyncio.wait(set(self.dispatching))
+
+
+async def serve_worker(host, port, reuse_port, worker=0):
+    """ Runs one worker until it is sent SIGTERM or SIGINT, then
+    drains it.  Each worker serves its metrics on its own port,
+    METRICS_PORT plus its number."""
+    from slack_client import SlackClient
+    from history import SqliteHistory
+    from ingest import SqliteDedupe
+    state_db = config.get('STATE_DB', 'state.db')
+    dedupe = SqliteDedupe(state_db)
+    bot = SlackClient(
+        bot_user_token=config.require('BOT_USER_TOKEN'),
+        bot_id=config.get('BOT_USER_ID'),
+        rtm=False,
+        history=SqliteHistory(state_db))
+    if bot.metrics_port:
+        bot.metrics_port += worker
+    server = EventsServer(bot, config.require('SLACK_SIGNING_SECRET'),
+                          dedupe=dedupe)
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+    await server.start(host, port, reuse_port)
+    try:
+        await stopping.wait()
+        # stop taking events before draining the ones we have
+        await server.stop()
+        await bot.shutdown()
+    finally:
+        await server.stop()
+        await bot.close()
+        dedupe.close()
+
+
+def run_worker(host, port, reuse_port, worker=0):
+    setup_logging()
+    try:
+        asyncio.run(serve_worker(host, port, reuse_port, worker))
+    except KeyboardInterrupt:
+        pass
+
+
+def serve(workers=1, host='0.0.0.0', port=3000):
+    """ Serves Slack events from `workers` processes sharing one port"""
+    if workers == 1:
+        run_worker(host, port, False)
+        return
+    # spawned, not forked: a fork would inherit a dead logging thread
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(
+        target=run_worker, args=(host, port, True, n), name=f'worker-{n}')
+        for n in range(workers)]
+    for process in processes:
+        process.start()
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    # take the workers down with us, terminate() lets them drain first
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+            process.join()
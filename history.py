@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""Stores of the comics the bot has shown, kept per channel.
+
+ChannelHistory keeps one process's history in memory and in an
+append-only log file.  SqliteHistory keeps it in sqlite, so several
+worker processes can share it.  Both keep at most `size` comics per
+channel."""
+
+import os
+import sys
+import time
+import asyncio
+import sqlite3
+import logging
+from array import array
+from collections import OrderedDict
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+# Guard against python2
+if sys.version_info[0] < 3:
+    raise RuntimeError("Python 3 is required")
+
+logger = logging.getLogger(__name__)
+
+
+class RingBuffer:
+    """ The last `size` comic numbers shown in a channel, in a fixed
+    array of unsigned shorts.  With the default size of 50 a channel
+    costs about 250 bytes: 100 bytes of numbers plus the array and
+    object headers."""
+
+    __slots__ = ('numbers', 'start', 'length')
+
+    def __init__(self, size):
+        self.numbers = array('H', bytes(2 * size))
+        self.start = 0
+        self.length = 0
+
+    def append(self, num):
+        size = len(self.numbers)
+        self.numbers[(self.start + self.length) % size] = num
+        if self.length < size:
+            self.length += 1
+        else:
+            self.start = (self.start + 1) % size
+
+    def last(self):
+        if not self.length:
+            return None
+        size = len(self.numbers)
+        return self.numbers[(self.start + self.length - 1) % size]
+
+    def to_list(self):
+        size = len(self.numbers)
+        return [self.numbers[(self.start + i) % size]
+                for i in range(self.length)]
+
+
+class ChannelHistory:
+    """ Per channel comic history for a single process.
+
+    Only the `max_channels` most recently active channels are kept;
+    idle channels past that are forgotten.  A full channel costs about
+    380 bytes: its ring buffer, its entry in the LRU and its name, as
+    measured by `python bench/microbench.py history`.  The default
+    1000 channels take under 400 KB.
+
+    Appends are written to an append-only log once `batch_size` are
+    pending, or `flush_interval` seconds after the first of them, by a
+    timer on the running loop.  The log is rewritten from memory once
+    it holds `compact_factor` times more entries than are live, so
+    loading it at startup stays cheap."""
+
+    def __init__(self, path='history.log', size=50, max_channels=1000,
+                 batch_size=20, flush_interval=1.0, compact_factor=4):
+        self.path = path
+        self.size = size
+        self.max_channels = max_channels
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.compact_factor = compact_factor
+        self.channels = OrderedDict()
+        self.pending = []
+        self.logged = 0
+        self._timer = None
+        self._lock = Lock()
+        if path:
+            self.load()
+
+    def _ring(self, channel):
+        ring = self.channels.get(channel)
+        if ring is None:
+            ring = self.channels[channel] = RingBuffer(self.size)
+            while len(self.channels) > self.max_channels:
+                self.channels.popitem(last=False)
+        else:
+            self.channels.move_to_end(channel)
+        return ring
+
+    def load(self):
+        """ Replays the log file into memory"""
+        if not os.path.exists(self.path):
+            return
+        start = time.monotonic()
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    channel, num = line.split()
+                    self._ring(channel).append(int(num))
+                except ValueError:
+                    # a torn last line from a crash
+                    continue
+                self.logged += 1
+        logger.info(f'Loaded comic history of {len(self.channels)} channels'
+                    f' in {time.monotonic() - start:.3f}s')
+
+    def append(self, channel, num):
+        """ Records that a comic was shown in a channel"""
+        with self._lock:
+            self._ring(channel).append(num)
+            if self.path:
+                self.pending.append(f'{channel} {num}\n')
+                if len(self.pending) >= self.batch_size:
+                    self._flush()
+                elif self._timer is None:
+                    self._schedule_flush()
+
+    def _schedule_flush(self):
+        """ Flushes flush_interval seconds from now, so a quiet
+        channel's last comics are not left pending.  Without a running
+        loop, pending appends wait for a full batch or close()."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._timer = loop.call_later(self.flush_interval, self.flush)
+
+    def last(self, channel):
+        """ The comic last shown in a channel, or None"""
+        ring = self.channels.get(channel)
+        return ring.last() if ring is not None else None
+
+    def get(self, channel):
+        """ The comics shown in a channel, oldest first"""
+        ring = self.channels.get(channel)
+        return ring.to_list() if ring is not None else []
+
+    def flush(self):
+        """ Writes pending appends to the log"""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.pending:
+            return
+        with open(self.path, 'a') as f:
+            f.writelines(self.pending)
+        self.logged += len(self.pending)
+        self.pending = []
+        live = sum(ring.length for ring in self.channels.values())
+        if self.logged > self.compact_factor * max(live, self.size):
+            self._compact(live)
+
+    def _compact(self, live):
+        """ Rewrites the log with only what is in memory"""
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for channel, ring in self.channels.items():
+                f.writelines(f'{channel} {num}\n' for num in ring.to_list())
+        os.replace(tmp, self.path)
+        logger.debug(f'Compacted comic history log from {self.logged} '
+                     f'to {live} entries')
+        self.logged = live
+
+    def close(self):
+        if self.path:
+            self.flush()
+
+
+class SqliteHistory:
+    """ Per channel comic history kept in sqlite, so several worker
+    processes share it.
+
+    Appends are written by a writer thread with its own connection,
+    since sqlite lets one process write at a time and a worker waiting
+    its turn must not stall its event loop.  Until an append is
+    committed, reads in this process see it from `pending`."""
+
+    def __init__(self, db_path='state.db', size=50):
+        self.db_path = db_path
+        self.size = size
+        self.pending = {}
+        self._lock = Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False,
+                                   timeout=10)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS history '
+            '(seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'channel TEXT NOT NULL, num INTEGER NOT NULL)')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS history_channel '
+            'ON history (channel, seq)')
+        self._db.commit()
+        self._write_db = sqlite3.connect(db_path, check_same_thread=False,
+                                         timeout=10)
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='history-db')
+
+    def append(self, channel, num):
+        with self._lock:
+            self.pending.setdefault(channel, []).append(num)
+        self._writer.submit(self._write, channel, num)
+
+    def _write(self, channel, num):
+        """ Writes an append, in the writer thread.  The wait for the
+        write lock happens outside self._lock, so reads go on."""
+        try:
+            self._write_db.execute(
+                'INSERT INTO history (channel, num) VALUES (?, ?)',
+                (channel, num))
+            self._write_db.execute(
+                'DELETE FROM history WHERE channel = ? AND seq <= '
+                '(SELECT seq FROM history WHERE channel = ? '
+                'ORDER BY seq DESC LIMIT 1 OFFSET ?)',
+                (channel, channel, self.size))
+            with self._lock:
+                self._write_db.commit()
+                self._written(channel)
+        except sqlite3.Error:
+            logger.exception(f'Could not store comic {num} in the history '
+                             f'of {channel}')
+            self._write_db.rollback()
+            with self._lock:
+                self._written(channel)
+
+    def _written(self, channel):
+        """ Drops the oldest pending append of a channel.
+        Caller must hold the lock."""
+        pending = self.pending[channel]
+        pending.pop(0)
+        if not pending:
+            del self.pending[channel]
+
+    def last(self, channel):
+        with self._lock:
+            pending = self.pending.get(channel)
+            if pending:
+                return pending[-1]
+            row = self._db.execute(
+                'SELECT num FROM history WHERE channel = ? '
+                'ORDER BY seq DESC LIMIT 1', (channel,)).fetchone()
+        return row[0] if row else None
+
+    def get(self, channel):
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT num FROM history WHERE channel = ? ORDER BY seq',
+                (channel,)).fetchall()
+            pending = self.pending.get(channel, [])
+        return ([num for num, in rows] + pending)[-self.size:]
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        self._write_db.close()
+        with self._lock:
+            self._db.close()
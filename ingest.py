@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""The first look at every message event the bot can see.  Most of them
+are not for us, so this has to be cheap: it drops other bots, edits,
+joins, messages that do not mention us, and events Slack delivers
+twice, before any command is parsed."""
+
+import sys
+import time
+import asyncio
+import sqlite3
+import logging
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+
+# Guard against python2
+if sys.version_info[0] < 3:
+    raise RuntimeError("Python 3 is required")
+
+logger = logging.getLogger(__name__)
+
+# Message subtypes that are never a person asking us for something.
+# Others, such as file_share, thread_broadcast and me_message, carry
+# text a person wrote and are read like plain messages.
+IGNORED_SUBTYPES = frozenset((
+    'bot_message', 'message_changed', 'message_deleted', 'message_replied',
+    'channel_join', 'channel_leave', 'group_join', 'group_leave',
+    'channel_topic', 'channel_purpose', 'channel_name', 'channel_archive',
+    'channel_unarchive', 'group_topic', 'group_purpose', 'group_name',
+    'group_archive', 'group_unarchive', 'pinned_item', 'unpinned_item',
+    'bot_add', 'bot_remove', 'ekm_access_denied', 'tombstone',
+))
+
+
+class IngestFilter:
+    """ Turns message events addressed to the bot into (command, args)
+    pairs, and everything else into None.  Commands that are numbers
+    are returned as ints.
+
+    The last `dedupe_size` (channel, ts) keys are remembered, so an
+    event redelivered after a reconnect is only handled once."""
+
+    def __init__(self, bot_id=None, dedupe_size=1000):
+        self.dedupe_size = dedupe_size
+        self.recent = OrderedDict()
+        self.skipped_subtype = 0
+        self.duplicates = 0
+        self.accepted = 0
+        self.set_bot_id(bot_id)
+
+    def set_bot_id(self, bot_id):
+        """ Builds the mention we look for"""
+        self.at_bot = f'<@{bot_id}>'
+
+    def accept(self, data):
+        """ Returns the command and args of a message for us, or None"""
+        if data.get('subtype') in IGNORED_SUBTYPES:
+            self.skipped_subtype += 1
+            return None
+        text = data.get('text')
+        # Most messages are turned away here.  They are not counted:
+        # that would cost a third of the time spent on them.
+        if not text or self.at_bot not in text:
+            return None
+        key = (data.get('channel'), data.get('ts'))
+        if key in self.recent:
+            self.duplicates += 1
+            logger.debug(f'Dropped a duplicate of message {key}')
+            return None
+        if key[1] is not None:
+            self.recent[key] = None
+            if len(self.recent) > self.dedupe_size:
+                self.recent.popitem(last=False)
+        self.accepted += 1
+        # the command runs up to the next mention, if any
+        words = text.partition(self.at_bot)[2].split('<', 1)[0].split()
+        if not words:
+            return '', []
+        cmd = words[0].lower()
+        # isdigit() would also take '²', which int() refuses
+        if cmd.isdecimal():
+            cmd = int(cmd)
+        return cmd, words[1:]
+
+    def snapshot(self):
+        """ Returns the recent (channel, ts) keys, oldest first"""
+        return list(self.recent)
+
+    def warm(self, keys):
+        """ Remembers keys from a snapshot, so events redelivered
+        across a restart are still dropped"""
+        for channel, ts in keys[-self.dedupe_size:]:
+            self.recent[(channel, ts)] = None
+
+    def stats(self):
+        return {
+            'skipped_subtype': self.skipped_subtype,
+            'duplicates': self.duplicates,
+            'accepted': self.accepted,
+        }
+
+
+class SqliteDedupe:
+    """ The (channel, ts) keys of the messages taken by any worker
+    process, kept in sqlite.  Slack retries an event it thinks was not
+    acknowledged, and the retry may reach another worker than the
+    first delivery did.  Keys are pruned once they are `max_age`
+    seconds old, long after Slack has stopped retrying.
+
+    Keys are claimed in a writer thread: sqlite lets one process write
+    at a time, and a worker waiting its turn must not stall its loop."""
+
+    def __init__(self, db_path='state.db', max_age=3600, prune_every=1000):
+        self.db_path = db_path
+        self.max_age = max_age
+        self.prune_every = prune_every
+        self.added = 0
+        self._lock = Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False,
+                                   timeout=10)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS seen_messages '
+            '(channel TEXT NOT NULL, ts TEXT NOT NULL, '
+            'received REAL NOT NULL, PRIMARY KEY (channel, ts))')
+        self._db.commit()
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='dedupe-db')
+
+    async def claim(self, key):
+        """ Records a key without blocking the loop.  Returns False if
+        it was already taken."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._writer, self.add, key)
+
+    def add(self, key):
+        """ Records a key.  Returns False if it was already taken."""
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                'INSERT OR IGNORE INTO seen_messages (channel, ts, received) '
+                'VALUES (?, ?, ?)', (key[0], key[1], now))
+            self.added += 1
+            if self.added % self.prune_every == 0:
+                self._db.execute(
+                    'DELETE FROM seen_messages WHERE received < ?',
+                    (now - self.max_age,))
+            self._db.commit()
+        return cursor.rowcount == 1
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        with self._lock:
+            self._db.close()
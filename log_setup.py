@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""Logging setup shared by every module.
+
+logging.yaml is read once.  The handlers it configures on the root
+logger are moved behind a queue and run on a background listener
+thread, so a slow disk or stdout never delays a reply.  The optional
+`async` section of the yaml tunes the queue and the suppression of
+noisy repeated warnings and errors.  Setting LOG_FORMAT=json switches
+every handler to one json object per line."""
+
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.config
+import logging.handlers
+from threading import Lock
+from collections import OrderedDict
+from datetime import datetime as dt
+
+# Guard against python2
+if sys.version_info[0] < 3:
+    raise RuntimeError("Python 3 is required")
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats a record as one line of json"""
+
+    def format(self, record):
+        entry = {
+            'time': dt.fromtimestamp(record.created).isoformat(
+                timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class RepeatFilter(logging.Filter):
+    """ Lets through at most `burst` copies of the same warning or error
+    per `window` seconds.  The next copy let through says how many
+    were suppressed.
+
+    Copies are told apart by the line that logged them, not by their
+    text, which usually has the comic or channel formatted into it.
+    Lines quiet for a whole window are forgotten, and at most
+    `max_keys` lines are tracked at once."""
+
+    def __init__(self, window=60, burst=5, max_keys=1000):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.max_keys = max_keys
+        # least recently logged line first
+        self.seen = OrderedDict()
+        self._lock = Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.name, record.levelno, record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            started, count, suppressed, _ = self.seen.pop(key,
+                                                          (now, 0, 0, now))
+            if now - started > self.window:
+                started, count = now, 0
+            if count >= self.burst:
+                self.seen[key] = (started, count, suppressed + 1, now)
+                return False
+            self.seen[key] = (started, count + 1, 0, now)
+            if len(self.seen) > self.max_keys:
+                self.seen.popitem(last=False)
+        if suppressed:
+            record.msg = f'{record.msg} [{suppressed} repeats suppressed]'
+        return True
+
+    def _prune(self, now):
+        """ Forgets the lines not logged for a whole window"""
+        while self.seen:
+            last = next(iter(self.seen.values()))[3]
+            if now - last <= self.window:
+                return
+            self.seen.popitem(last=False)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ A QueueHandler that drops records rather than block
+    when the listener falls behind"""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(path='logging.yaml'):
+    """ Configures logging from the yaml file, once"""
+    global _listener
+    if _listener is not None:
+        return
+    import yaml
+    with open(path) as f:
+        config = yaml.safe_load(f.read())
+    options = config.pop('async', None) or {}
+    logging.config.dictConfig(config)
+
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    if os.environ.get('LOG_FORMAT') == 'json':
+        for handler in handlers:
+            handler.setFormatter(JsonFormatter())
+    for handler in handlers:
+        root.removeHandler(handler)
+
+    queue_handler = DroppingQueueHandler(
+        queue.Queue(options.get('queue_size', 10000)))
+    suppress = options.get('suppress_repeats')
+    if suppress:
+        queue_handler.addFilter(RepeatFilter(**suppress))
+    root.addHandler(queue_handler)
+    _listener = logging.handlers.QueueListener(
+        queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """ Writes out every queued record and stops the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def config_logger(name):
+    """ Returns a module logger, setting up logging on first use"""
+    setup_logging()
+    return logging.getLogger(name)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Counters and latency histograms for each stage of handling a command,
+with Prometheus text and json export"""
+
+import sys
+import json
+import logging
+from bisect import bisect_left
+
+# Guard against python2
+if sys.version_info[0] < 3:
+    raise RuntimeError("Python 3 is required")
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds, the last bucket catches everything else
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+class Histogram:
+    """ Counts observations into fixed latency buckets"""
+
+    __slots__ = ('counts', 'count', 'total', 'errors')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+
+    def observe(self, seconds, error=False):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if error:
+            self.errors += 1
+
+    def percentile(self, pct):
+        """ Returns the upper bound of the bucket holding a percentile"""
+        if not self.count:
+            return 0
+        rank = pct / 100 * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return BUCKETS[-1]
+
+
+class Metrics:
+    """ Latency histograms keyed by (stage, command).  Other parts of the
+    bot register a `source`: a callable returning a dict of numbers,
+    exported as gauges under the source's name."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.sources = {}
+
+    def observe(self, stage, command, seconds, error=False):
+        """ Records how long a stage took for a command"""
+        key = (stage, command)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds, error)
+
+    def add_source(self, name, source):
+        self.sources[name] = source
+
+    def gauges(self):
+        """ Returns the numeric values of every registered source"""
+        gauges = {}
+        for name, source in self.sources.items():
+            try:
+                values = source()
+            except Exception:
+                logger.exception(f'Metrics source {name} failed')
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)):
+                    gauges[f'{name}_{key}'] = value
+        return gauges
+
+    def snapshot(self):
+        """ Returns every metric as a json-able dict"""
+        stages = {}
+        for (stage, command), h in sorted(self.histograms.items()):
+            stages.setdefault(stage, {})[command] = {
+                'count': h.count,
+                'errors': h.errors,
+                'sum': round(h.total, 6),
+                'p50': h.percentile(50),
+                'p95': h.percentile(95),
+                'p99': h.percentile(99),
+            }
+        return {'stages': stages, 'gauges': self.gauges()}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), default=str)
+
+    def to_prometheus(self):
+        """ Returns every metric in the Prometheus text format"""
+        lines = ['# TYPE slackxkcd_stage_seconds histogram']
+        for (stage, command), h in sorted(self.histograms.items()):
+            labels = f'stage="{stage}",command="{command}"'
+            seen = 0
+            for bound, count in zip(BUCKETS, h.counts):
+                seen += count
+                le = '+Inf' if bound == float('inf') else bound
+                lines.append(f'slackxkcd_stage_seconds_bucket'
+                             f'{{{labels},le="{le}"}} {seen}')
+            lines.append(f'slackxkcd_stage_seconds_sum{{{labels}}} {h.total}')
+            lines.append(f'slackxkcd_stage_seconds_count{{{labels}}} '
+                         f'{h.count}')
+            lines.append(f'slackxkcd_stage_errors_total{{{labels}}} '
+                         f'{h.errors}')
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f'slackxkcd_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, port, host='127.0.0.1'):
+        """ Serves /metrics (Prometheus text) and /metrics.json"""
+        from aiohttp import web
+
+        async def prometheus(request):
+            return web.Response(text=self.to_prometheus())
+
+        async def as_json(request):
+            return web.Response(text=self.to_json(),
+                                content_type='application/json')
+        app = web.Application()
+        app.router.add_get('/metrics', prometheus)
+        app.router.add_get('/metrics.json', as_json)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f'Serving metrics on http://{host}:{port}/metrics')
+        return runner
+
+
+# the bot's metrics, shared by every module
+registry = Metrics()
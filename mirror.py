@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""An offline mirror of every xkcd comic's metadata,
+and a full text search over it"""
+
+import re
+import sys
+import time
+import asyncio
+import logging
+from collections import defaultdict
+
+# Guard against python2
+if sys.version_info[0] < 3:
+    raise RuntimeError("Python 3 is required")
+
+logger = logging.getLogger(__name__)
+
+WORD = re.compile(r"[a-z0-9]+")
+
+
+def words(text):
+    """ Splits text into lowercase search terms"""
+    return WORD.findall(text.lower())
+
+
+async def sync_comics(xkcd, concurrency=8):
+    """ Downloads every comic that is not already in the comic cache.
+    Comics are stored as they arrive, so an interrupted sync
+    resumes where it left off.  Returns the numbers that failed."""
+    await xkcd.ensure_last()
+    have = xkcd.cache.numbers()
+    missing = [n for n in xkcd.index if n not in have]
+    logger.info(f'Mirroring {len(missing)} comics, '
+                f'{len(have)} already stored')
+    slots = asyncio.Semaphore(concurrency)
+    failed = []
+    start = time.monotonic()
+
+    async def fetch(comic_number):
+        async with slots:
+            try:
+                await xkcd.fetch_comic(comic_number)
+            except Exception as err:
+                failed.append(comic_number)
+                logger.warning(f'Could not mirror comic {comic_number}: '
+                               f'{err}')
+
+    await asyncio.gather(*[fetch(n) for n in missing])
+    logger.info(f'Mirrored {len(missing) - len(failed)} comics in '
+                f'{time.monotonic() - start:.1f}s, {len(failed)} failed')
+    return sorted(failed)
+
+
+class SearchIndex:
+    """ An in-memory inverted index from search terms to comic numbers,
+    over the title, alt text and transcript of every stored comic.
+    It keeps itself current by listening to the comic cache."""
+
+    def __init__(self):
+        self.postings = defaultdict(set)
+        self.titles = {}
+
+    @classmethod
+    def from_cache(cls, cache):
+        """ Builds an index of every comic in a ComicCache"""
+        index = cls()
+        index.add_all(cache.all_comics())
+        cache.listeners.append(index.add)
+        return index
+
+    def __len__(self):
+        return len(self.titles)
+
+    def add(self, comic_object):
+        """ Indexes one comic"""
+        num = comic_object['num']
+        self.titles[num] = comic_object.get('safe_title',
+                                            comic_object.get('title', ''))
+        text = ' '.join(comic_object.get(field) or '' for field in
+                        ('title', 'alt', 'transcript'))
+        for term in set(words(text)):
+            self.postings[term].add(num)
+
+    def add_all(self, comic_objects):
+        """ Indexes many comics"""
+        for comic_object in comic_objects:
+            self.add(comic_object)
+
+    def search(self, query, limit=5):
+        """ Returns the numbers of the comics containing every word of
+        the query, title matches first, then newest first"""
+        terms = words(query)
+        if not terms:
+            return []
+        matches = set.intersection(
+            *(self.postings.get(term, set()) for term in terms))
+
+        def rank(num):
+            title = words(self.titles[num])
+            return (-sum(term in title for term in terms), -num)
+        return sorted(matches, key=rank)[:limit]
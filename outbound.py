@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""A rate limit aware queue for messages going out to Slack"""
+
+import sys
+import time
+import asyncio
+import logging
+
+# Guard against python2
+if sys.version_info[0] < 3:
+    raise RuntimeError("Python 3 is required")
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """ Allows `rate` sends per second, with bursts of up to `capacity`"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """ Takes a token.  Returns how many seconds to wait first,
+        which is 0 when a token was available."""
+        self.refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def try_take(self):
+        """ Takes a token if one is available, without going into debt"""
+        self.refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def is_full(self, now):
+        """ Whether the bucket has refilled to capacity by `now`, which
+        makes it no different from a new one"""
+        return (self.tokens + (now - self.updated) * self.rate >=
+                self.capacity)
+
+
+class TokenBuckets:
+    """ A token bucket for each key, made on first use.  Buckets that
+    have refilled to capacity are dropped once the map has doubled in
+    size since the last sweep, so only the keys seen in the last
+    capacity / rate seconds are kept, however many keys come and go."""
+
+    def __init__(self, rate, capacity, sweep_size=256):
+        self.rate = rate
+        self.capacity = capacity
+        self.sweep_size = sweep_size
+        self._sweep_at = sweep_size
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def get(self, key):
+        """ Returns the bucket of key, making it if needed"""
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self._sweep_at:
+                self.sweep()
+            bucket = self.buckets[key] = TokenBucket(self.rate,
+                                                     self.capacity)
+        return bucket
+
+    def sweep(self):
+        """ Drops the buckets that have refilled to capacity"""
+        now = time.monotonic()
+        full = [key for key, bucket in self.buckets.items()
+                if bucket.is_full(now)]
+        for key in full:
+            del self.buckets[key]
+        self._sweep_at = max(self.sweep_size, 2 * len(self.buckets))
+        if full:
+            logger.debug(f'Dropped {len(full)} idle token buckets')
+
+
+def retry_after(err):
+    """ Returns the Retry-After seconds of a rate limited Slack
+    error, or None if the error was not a 429."""
+    response = getattr(err, 'response', None)
+    if response is None or getattr(response, 'status_code', None) != 429:
+        return None
+    headers = getattr(response, 'headers', None) or {}
+    return float(headers.get('Retry-After', 1))
+
+
+class OutboundQueue:
+    """ A bounded queue of outgoing messages, drained by a small pool of
+    sender tasks.  Every channel has its own token bucket, and a 429
+    from Slack pauses all senders for the Retry-After it asks for."""
+
+    def __init__(self, send, workers=3, maxsize=100,
+                 rate=1.0, burst=3, max_retries=3):
+        self.send = send
+        self.workers = workers
+        self.maxsize = maxsize
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.queue = None
+        self.buckets = TokenBuckets(rate, burst)
+        self.resume_at = 0
+        self._tasks = []
+        self.sent = 0
+        self.failed = 0
+        self.throttled = 0
+        self.retries = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        """ Starts the sender pool on the running loop"""
+        if self._tasks:
+            return
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [asyncio.ensure_future(self._worker(n))
+                       for n in range(self.workers)]
+
+    async def put(self, chan, blocks):
+        """ Queues a message.  Waits for room when the queue is full."""
+        self.start()
+        await self.queue.put((chan, blocks, time.monotonic()))
+
+    async def join(self):
+        """ Waits until every queued message has been handled"""
+        if self.queue is not None:
+            await self.queue.join()
+
+    async def stop(self):
+        """ Stops the sender pool.  Queued messages are not sent."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _wait_for_token(self, chan):
+        delay = max(self.buckets.get(chan).take(), self.resume_at - time.monotonic())
+        if delay > 0:
+            self.throttled += 1
+            await asyncio.sleep(delay)
+
+    async def _worker(self, n):
+        while True:
+            chan, blocks, queued_at = await self.queue.get()
+            try:
+                await self._deliver(chan, blocks)
+                elapsed = time.monotonic() - queued_at
+                self.sent += 1
+                self.latency_total += elapsed
+                self.latency_max = max(self.latency_max, elapsed)
+            except asyncio.CancelledError:
+                # an Exception before python 3.8: stop() must get through
+                raise
+            except Exception:
+                self.failed += 1
+                logger.exception(f'Could not post message to {chan}')
+            finally:
+                self.queue.task_done()
+
+    async def _deliver(self, chan, blocks):
+        """ Sends one message, honouring Retry-After on a 429"""
+        for attempt in range(self.max_retries + 1):
+            await self._wait_for_token(chan)
+            try:
+                return await self.send(chan, blocks)
+            except Exception as err:
+                wait = retry_after(err)
+                if wait is None or attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                self.resume_at = max(self.resume_at, time.monotonic() + wait)
+                logger.warning(f'Rate limited by Slack, retrying {chan} '
+                               f'in {wait}s')
+
+    def stats(self):
+        """ Returns queue depth, send latency and throttle counters"""
+        return {
+            'depth': self.queue.qsize() if self.queue is not None else 0,
+            'sent': self.sent,
+            'failed': self.failed,
+            'throttled': self.throttled,
+            'retries': self.retries,
+            'latency_avg': self.latency_total / self.sent if self.sent else 0,
+            'latency_max': self.latency_max,
+        }
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Renders Slack block payloads, serializing each one only once"""
+
+import sys
+import json
+from collections import OrderedDict
+from threading import Lock
+
+# Guard against python2
+if sys.version_info[0] < 3:
+    raise RuntimeError("Python 3 is required")
+
+
+def text_to_blocks(message):
+    """ Returns a printable blocks format of a text message."""
+    blocks = [{
+        "type": "section",
+        "text": {
+            "type": "mrkdwn",
+            "text": message
+        }
+    }]
+    return json.dumps(blocks)
+
+
+def comic_to_blocks(comic_object):
+    """ Returns the JSON format block object used for printing in Slack"""
+    blocks = [{
+        "type": "image",
+        "title": {
+            "type": "plain_text",
+            "text": comic_object['title']
+        },
+        "image_url": comic_object['img'],
+        "alt_text": comic_object['alt']
+    }
+    ]
+    return json.dumps(blocks)
+
+
+def merge_blocks(payloads, max_blocks=50):
+    """ Joins serialized block lists into as few messages as Slack's
+    limit of blocks per message allows.  Returns a list of payloads."""
+    messages, current, count = [], [], 0
+    for payload in payloads:
+        size = len(json.loads(payload))
+        if current and count + size > max_blocks:
+            messages.append('[' + ','.join(current) + ']')
+            current, count = [], 0
+        current.append(payload.strip()[1:-1])
+        count += size
+    if current:
+        messages.append('[' + ','.join(current) + ']')
+    return messages
+
+
+class BlockRenderer:
+    """ Keeps serialized block payloads so the hot path can hand a
+    ready made string to chat_postMessage.  Comic payloads are keyed by
+    comic number, since a published comic never changes.  Static text
+    replies are registered once at startup."""
+
+    def __init__(self, max_comics=1024):
+        self.max_comics = max_comics
+        self._comics = OrderedDict()
+        self._static = {}
+        self._lock = Lock()
+
+    def comic(self, comic_object):
+        """ Returns the serialized blocks of a comic"""
+        num = comic_object['num']
+        with self._lock:
+            blocks = self._comics.get(num)
+            if blocks is not None:
+                self._comics.move_to_end(num)
+                return blocks
+        blocks = comic_to_blocks(comic_object)
+        with self._lock:
+            self._comics[num] = blocks
+            if len(self._comics) > self.max_comics:
+                self._comics.popitem(last=False)
+        return blocks
+
+    def add_static(self, name, message):
+        """ Serializes a reply that never changes"""
+        self._static[name] = text_to_blocks(message)
+
+    def static(self, name):
+        """ Returns the serialized blocks of a static reply"""
+        return self._static[name]
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Retries and a circuit breaker for calls to upstream services"""
+
+import sys
+import time
+import random
+import asyncio
+import logging
+
+# Guard against python2
+if sys.version_info[0] < 3:
+    raise RuntimeError("Python 3 is required")
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamUnavailable(Exception):
+    """ The upstream service did not answer within our budget"""
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    """ The circuit breaker is failing calls fast"""
+
+
+class CircuitBreaker:
+    """ Fails calls fast after `threshold` failures in a row.  After
+    `reset_timeout` seconds one trial call is let through: if it works
+    the circuit closes again, otherwise it stays open."""
+
+    def __init__(self, name, threshold=5, reset_timeout=30):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.rejected = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        """ Raises CircuitOpenError unless a call may go ahead"""
+        state = self.state
+        if state == 'closed':
+            return
+        if state == 'half-open' and not self.trial_running:
+            self.trial_running = True
+            return
+        self.rejected += 1
+        raise CircuitOpenError(f'{self.name} circuit is open')
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f'{self.name} circuit closed')
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_running = False
+        if self.failures >= self.threshold:
+            if self.state != 'open':
+                logger.warning(f'{self.name} circuit opened after '
+                               f'{self.failures} failures')
+            self.opened_at = time.monotonic()
+
+
+async def retry(call, should_retry, attempts=3, base_delay=0.2,
+                deadline=None):
+    """ Awaits call() until it succeeds, retrying errors that
+    should_retry(err) accepts with jittered exponential backoff.
+    No retry is started that would finish after the deadline,
+    a time.monotonic() value."""
+    for attempt in range(attempts):
+        try:
+            return await call()
+        except Exception as err:
+            delay = random.uniform(0, base_delay * 2 ** attempt)
+            out_of_time = (deadline is not None and
+                           time.monotonic() + delay >= deadline)
+            if (attempt == attempts - 1 or out_of_time or
+                    not should_retry(err)):
+                raise
+            logger.debug(f'Retrying in {delay:.2f}s after: {err!r}')
+            await asyncio.sleep(delay)
@@ -2,33 +2,41 @@
 
 # TODO : write README
 
-import yaml
 import sys
 import os
-from slack import RTMClient, WebClient
-from dotenv import load_dotenv
-import logging.config
+import json
 import logging
 from datetime import datetime as dt
 import signal
+import asyncio
+import time
+import collections
 from threading import Lock
-from xkcd import XkcdApi
-import json
+from xkcd import AsyncXkcdApi
+import rendering
+from outbound import OutboundQueue
+from mirror import SearchIndex
+from history import ChannelHistory
+from ingest import IngestFilter
+from admission import AdmissionControl, LOCAL, FETCH, BATCH
+from resilience import UpstreamUnavailable
+from metrics import registry
+from log_setup import setup_logging
+import config
 
 # Guard against Python 2
 if sys.version_info[0] < 3:
     raise RuntimeError("This program requires Python 3")
 
-load_dotenv()
-
 # globals
 goodbye_posted_flag = False
 BOT_NAME = "while_xkcd"
 BOT_CHAN = "#janell-bot-test"
-WEBHOOK_URL = os.environ['WEBHOOK_URL']
+SLACK_API_URL = 'https://www.slack.com/api/'
 bot_commands = {
     'help': 'Shows this helpful command reference.',
     'ping': 'Shows the uptime of this bot.',
+    'stats': 'Shows command counts, error rates and latencies.',
     'exit': 'Shut down the entire bot. (Requires app restart)',
     'quit': 'Same as \'exit\'.',
     'first': 'Shows the first xkcd comic.',
@@ -36,10 +44,14 @@ bot_commands = {
     'previous': 'Shows the comic published prior to the one last shown.',
     'next': 'Shows the next comic published after the one last shown.',
     'random': 'Shows a random comic.',
+    'random-unseen': 'Shows a random comic not yet shown in this channel.',
     '[int]': 'Shows the comic indexed by the integer.',
-    'history': ('Prints an orderd list of all'
-                'comics shown since app restart.'),
-    'api': 'Helpfully shows xkcd\'s api helpful documentation. Sort of.'
+    '[int] [int] ...': 'Shows several comics at once.',
+    'range <a>-<b>': 'Shows comics a through b, a few at a time.',
+    'history': 'Prints the comics last shown in this channel.',
+    'api': 'Helpfully shows xkcd\'s api helpful documentation. Sort of.',
+    'search <words>': ('Lists comics whose title, alt text or transcript'
+                       ' contain all the words.')
 }
 
 
@@ -51,45 +63,123 @@ def formatted_dict(d):
     return "```\n" + '\n'.join(lines) + "\n```"
 
 
-def config_logger():
-    """ Setup logging configuration """
-    with open('logging.yaml') as f:
-        config = yaml.safe_load(f.read())
-        logging.config.dictConfig(config)
-    return logging.getLogger(__name__)
+# commands known by name, so metrics labels stay bounded
+named_commands = {'raise', 'help', 'ping', 'stats', 'exit', 'quit', 'first',
+                  'last', 'random', 'random-unseen', 'next', 'previous',
+                  'api', 'history', 'search', 'range'}
+
+
+def command_label(cmd):
+    """ Returns the metrics label of a parsed command"""
+    if isinstance(cmd, int):
+        return '[int]'
+    return cmd if cmd in named_commands else 'unknown'
+
 
+# commands answered without asking xkcd
+local_commands = {'raise', 'help', 'ping', 'stats', 'exit', 'quit',
+                  'history', 'search'}
 
-logger = config_logger()
+
+def command_priority(cmd, args):
+    """ Returns the admission priority of a parsed command"""
+    if isinstance(cmd, int):
+        return BATCH if args else FETCH
+    if cmd == 'range':
+        return BATCH
+    if cmd in named_commands and cmd not in local_commands:
+        return FETCH
+    return LOCAL
+
+
+logger = logging.getLogger(__name__)
 
 
 class SlackClient:
     """ A stand-alone Slack client that can post xkcd images to Slack"""
 
-    def __init__(self, bot_user_token, bot_id=None):
+    def __init__(self, bot_user_token, bot_id=None, slack_api_url=None,
+                 rtm=True, history=None):
+        init_start = dt.now()
         self.name = BOT_NAME
+        # Without a bot_id we learn it from rtm.connect, see on_open
         self.bot_id = bot_id
-        if not self.bot_id:
-            # Read the bot's id by calling auth.test
-            response = WebClient(token=bot_user_token).api_call('auth.test')
-            self.bot_id = response['user_id']
-            logger.info(f'My bot_id is {self.bot_id}')
-
-        # Create an instance of the RTM client
-        self.sc = RTMClient(token=bot_user_token, run_async=True)
-
-        # Connect our callback events to the RTM client
-        RTMClient.run_on(event="hello")(self.on_hello)
-        RTMClient.run_on(event="message")(self.on_message)
-        RTMClient.run_on(event="goodbye")(self.on_goodbye)
-
-        # startup our client event loop
-        self.future = self.sc.start()
+        self.max_batch = config.get('MAX_BATCH', 10, int)
+        self.metrics_port = config.get('METRICS_PORT', None, int)
+        slack_api_url = slack_api_url or config.get('SLACK_API_URL',
+                                                    SLACK_API_URL)
+
+        if rtm:
+            from slack import RTMClient
+            # Create an instance of the RTM client
+            self.sc = RTMClient(token=bot_user_token, run_async=True,
+                                base_url=slack_api_url)
+            self.web_client = None
+
+            # Connect our callback events to the RTM client.  RTMClient.run_on
+            # registers on the class, shared by every client in the process,
+            # so each client gets its own callback table instead.
+            self.sc._callbacks = collections.defaultdict(list)
+            self.sc._callbacks['open'].append(self.on_open)
+            self.sc._callbacks['hello'].append(self.on_hello)
+            self.sc._callbacks['message'].append(self.on_message)
+            self.sc._callbacks['goodbye'].append(self.on_goodbye)
+
+            # startup our client event loop
+            self.future = self.sc.start()
+        else:
+            # Events are pushed to us, see events_api.py
+            from slack import WebClient
+            self.sc = None
+            self.future = None
+            self.web_client = WebClient(token=bot_user_token, run_async=True,
+                                        base_url=slack_api_url)
         self.bot_start = dt.now()
         self.msg_lock = Lock()
         self.at_bot = f'<@{self.bot_id}>'
-        self.comic_history = []
+        self.ingest = IngestFilter(
+            self.bot_id, config.get('DEDUPE_SIZE', 1000, int))
+        self.routes = self.build_routes()
+        self.admission = AdmissionControl(
+            max_inflight=config.get('ADMIT_MAX_INFLIGHT', 16, int),
+            reserved=config.get('ADMIT_RESERVED', 2, int),
+            maxsize=config.get('ADMIT_QUEUE', 100, int),
+            user_rate=config.get('USER_RATE', 1.0, float),
+            user_burst=config.get('USER_BURST', 5, int),
+            channel_rate=config.get('CHANNEL_RATE', 5.0, float),
+            channel_burst=config.get('CHANNEL_BURST', 20, int))
+        if history is None:
+            history = ChannelHistory(
+                config.get('HISTORY_LOG', 'history.log'),
+                size=config.get('HISTORY_SIZE', 50, int),
+                max_channels=config.get('HISTORY_CHANNELS', 1000, int))
+        self.comic_history = history
+        self.tasks = set()
+        self.draining = False
+        self.shutdown_task = None
+        self.shutdown_timeout = config.get('SHUTDOWN_TIMEOUT', 10, float)
+        self.snapshot_path = config.get('SNAPSHOT_PATH', 'snapshot.json')
+        self.first_reply = None
+        self.outbound = OutboundQueue(
+            self.send_message,
+            workers=config.get('SLACK_SEND_WORKERS', 3, int),
+            rate=config.get('SLACK_CHANNEL_RATE', 1.0, float))
         logger.info("Created new SlackClient Instance")
-        self.xkcd = XkcdApi()
+        self.xkcd = AsyncXkcdApi()
+        self.renderer = self.xkcd.renderer
+        # built from the comic cache in a thread once we are connected
+        self.search_index = None
+        self.indexing = None
+        self.render_static_replies()
+        self.metrics_server = None
+        registry.add_source('cache', self.xkcd.cache.stats)
+        registry.add_source('xkcd', self.xkcd.stats)
+        registry.add_source('outbound', self.outbound.stats)
+        registry.add_source('ingest', self.ingest.stats)
+        registry.add_source('admission', self.admission.stats)
+        self.warm_start = self.load_snapshot()
+        logger.info(f'{"Warm" if self.warm_start else "Cold"} start took '
+                    f'{dt.now() - init_start}')
 
     def __enter__(self):
         """ Allows this class to be used as a context manager."""
@@ -106,75 +196,190 @@ class SlackClient:
     def __str__(self):
         return self.__repr__()
 
-    def on_hello(self, **payload):
+    def render_static_replies(self):
+        """ Serializes every reply that never changes, once, at startup"""
+        add = self.renderer.add_static
+        add('online', f'{self.name} is now online.')
+        add('raise', "Manual exception handler test")
+        add('help', "Available commands: \n" + formatted_dict(bot_commands))
+        add('quit', 'See you next time!')
+        add('no_next', 'I\'m sorry.  There must be a first to be a next.\n'
+            'Please try this after you have requested a comic.')
+        add('no_previous',
+            'I\'m sorry.  There must be a first to be a previous.\n'
+            'Please try this after you have requested a comic.')
+        add('goodbye', 'Goodbye, cruel world...')
+        add('unavailable', 'xkcd is not answering right now.  '
+            'Please try again in a moment.')
+        add('slow_down', 'Whoa, slow down!  I\'ll answer again shortly.')
+        add('indexing', 'I\'m still indexing the comics for search.  '
+            'Please try again in a moment.')
+
+    def set_bot_id(self, bot_id):
+        """ Sets the id we answer mentions of"""
+        self.bot_id = bot_id
+        self.at_bot = f'<@{self.bot_id}>'
+        self.ingest.set_bot_id(bot_id)
+        logger.info(f'My bot_id is {self.bot_id}')
+
+    async def on_open(self, **payload):
+        """ The websocket is open.  rtm.connect told us who we are."""
+        if not self.bot_id:
+            self.set_bot_id(payload['data']['self']['id'])
+
+    async def ensure_bot_id(self):
+        """ Looks up our id with auth.test when we were not given one
+        and have no RTM connection to learn it from."""
+        if not self.bot_id:
+            response = await self.web_client.auth_test()
+            self.set_bot_id(response['user_id'])
+
+    async def on_hello(self, **payload):
         """ When Slack has confirmed our connection request"""
         logger.info(f'{self} has connected to the Slack RTM server.')
-        self.post_message(self.text_to_blocks(f'{self.name} is now online.'))
-
-    def on_message(self, **payload):
-        """ Slack has sent a message to me"""
+        self.xkcd.start_refresher()
+        self.start_indexing()
+        await self.start_metrics()
+        await self.post_message(self.renderer.static('online'))
+
+    async def start_metrics(self):
+        """ Serves metrics on metrics_port, once, if it is set"""
+        if self.metrics_port and self.metrics_server is None:
+            self.metrics_server = await registry.serve(self.metrics_port)
+
+    def start_indexing(self):
+        """ Starts building the search index, once"""
+        if self.indexing is None:
+            self.indexing = asyncio.ensure_future(self.build_search_index())
+
+    async def build_search_index(self):
+        """ Indexes every stored comic in a thread, so the loop keeps
+        serving messages while thousands of comics are parsed"""
+        index = SearchIndex()
+        # comics stored while we build are indexed as they arrive
+        self.xkcd.cache.listeners.append(index.add)
+        start = time.perf_counter()
+        await asyncio.get_running_loop().run_in_executor(
+            None, lambda: index.add_all(self.xkcd.cache.all_comics()))
+        self.search_index = index
+        logger.info(f'Indexed {len(index)} comics for search in '
+                    f'{time.perf_counter() - start:.2f}s')
+
+    async def on_message(self, **payload):
+        """ Slack has sent a message to me.  Commands are run as their
+        own tasks, once admitted, so the RTM loop keeps reading while a
+        fetch is in flight."""
+        received = time.perf_counter()
         data = payload['data']
         # Used to verify that we're not trying to shut down
         self.check_goodbye(data)
-        if 'text' in data and self.at_bot in data['text']:
-            chan = data['channel']
-            cmd = self.parse_command(data['text'])
-            response = self.handle_command(cmd)
-            self.post_message(response, chan)
-
-    def parse_command(self, typed_text):
-        """ Parses the text typed by the user into a
-        single word command to execute."""
-        raw_command = typed_text.split(self.at_bot)[1]
-        cmd = raw_command.strip().lower().split()[0]
-        cmd = self.try_to_change_cmd_to_int(cmd)
+        if self.draining:
+            return
+        command = self.ingest.accept(data)
+        if command is None:
+            return
+        cmd, args = command
+        registry.observe('parse', command_label(cmd),
+                         time.perf_counter() - received)
+        text, chan, user = data['text'], data['channel'], data.get('user')
+        shed = self.admission.submit(
+            lambda: self.respond(text, chan, cmd, args, received),
+            command_priority(cmd, args), user, chan, command_label(cmd))
+        if shed and self.admission.should_warn(user):
+            task = asyncio.ensure_future(
+                self.post_message(self.renderer.static('slow_down'), chan))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def respond(self, text, chan, cmd, args, received=None):
+        """ Handles a command, then posts the reply.  It runs once the
+        command is admitted, so the handle stage starts here; the total
+        runs from the message arriving, and includes the parse and
+        admit stages on_message and AdmissionControl record."""
+        dequeued = time.perf_counter()
+        start = received or dequeued
+        label, stage, stage_start = command_label(cmd), 'handle', dequeued
         logger.info(f'{self} Received command "{cmd}"')
-        return cmd
-
-    def handle_command(self, cmd):
-        """Routes the command received to the appropriate handler."""
-        if cmd == 'raise':
-            response = self.handle_raise()
-        elif cmd == 'help':
-            response = self.handle_help()
-        elif cmd == 'ping':
-            response = self.handle_ping()
-        elif cmd == 'exit' or cmd == 'quit':
-            response = self.handle_quit()
-        elif isinstance(cmd, int) or cmd in ['first', 'last', 'random']:
-            response = self.handle_comic_request(cmd)
-        elif cmd == 'next':
-            response = self.handle_next()
-        elif cmd == 'previous':
-            response = self.handle_previous()
-        elif cmd == 'api':
-            response = self.handle_api()
-        elif cmd == 'history':
-            response = self.handle_history()
+        try:
+            response = await self.handle_command(cmd, args, chan)
+            handled = time.perf_counter()
+            registry.observe('handle', label, handled - dequeued)
+            stage, stage_start = 'queue', handled
+            # batch commands may answer with more than one message
+            if not isinstance(response, list):
+                response = [response]
+            for blocks in response:
+                await self.post_message(blocks, chan)
+            registry.observe('queue', label, time.perf_counter() - handled)
+            registry.observe('total', label, time.perf_counter() - start)
+            if self.first_reply is None:
+                self.first_reply = dt.now() - self.bot_start
+                logger.info(f'First reply queued {self.first_reply} after '
+                            f'{"a warm" if self.warm_start else "a cold"} '
+                            'start')
+        except asyncio.CancelledError:
+            # abandoned by a drain
+            raise
+        except Exception:
+            registry.observe(stage, label, time.perf_counter() - stage_start,
+                             True)
+            registry.observe('total', label, time.perf_counter() - start,
+                             True)
+            logger.exception(f'{self} failed to respond to "{text}"')
+
+    def build_routes(self):
+        """ Returns the handler of each command word.  Every route
+        takes (cmd, args, chan) and may return a coroutine."""
+        def comic(cmd, args, chan):
+            return self.handle_comic_request(cmd, chan)
+        return {
+            'raise': lambda cmd, args, chan: self.handle_raise(),
+            'help': lambda cmd, args, chan: self.handle_help(),
+            'ping': lambda cmd, args, chan: self.handle_ping(),
+            'stats': lambda cmd, args, chan: self.handle_stats(),
+            'exit': lambda cmd, args, chan: self.handle_quit(),
+            'quit': lambda cmd, args, chan: self.handle_quit(),
+            'range': lambda cmd, args, chan: self.handle_range(args, chan),
+            'first': comic,
+            'last': comic,
+            'random': comic,
+            'random-unseen': comic,
+            'next': lambda cmd, args, chan: self.handle_next(chan),
+            'previous': lambda cmd, args, chan: self.handle_previous(chan),
+            'api': lambda cmd, args, chan: self.handle_api(chan),
+            'history': lambda cmd, args, chan: self.handle_history(chan),
+            'search': lambda cmd, args, chan: self.handle_search(args),
+        }
+
+    def route_number(self, cmd, args, chan):
+        """ A number shows that comic, several numbers show them all"""
+        if args and all(arg.isdecimal() for arg in args):
+            return self.handle_batch([cmd] + [int(arg) for arg in args],
+                                     chan)
+        return self.handle_comic_request(cmd, chan)
+
+    async def handle_command(self, cmd, args=(), chan=BOT_CHAN):
+        """Routes the command received in a channel
+        to the appropriate handler."""
+        if isinstance(cmd, int):
+            response = self.route_number(cmd, args, chan)
+        elif cmd in self.routes:
+            response = self.routes[cmd](cmd, args, chan)
         else:
             response = self.handle_not_command(cmd)
+        if asyncio.iscoroutine(response):
+            response = await response
         return response
 
-    def try_to_change_cmd_to_int(self, cmd):
-        """ If a number string is passed in, we want
-        to change that to an integer."""
-        try:
-            cmd = int(cmd)
-        except Exception:
-            pass
-        finally:
-            return cmd
-
     def handle_raise(self):
         """ Tests the response to a manually raised exception."""
-        response = self.text_to_blocks("Manual exception handler test")
+        response = self.renderer.static('raise')
         raise Exception("Manual exception handler test.")
         return response
 
     def handle_help(self):
         """ Returns a printable block of available commands"""
-        response = self.text_to_blocks(
-            "Available commands: \n" + formatted_dict(bot_commands))
+        response = self.renderer.static('help')
         return response
 
     def handle_ping(self):
@@ -183,58 +388,139 @@ class SlackClient:
             f'{self.name} has been running for {self.get_uptime()}.')
         return response
 
+    def handle_stats(self):
+        """ Returns a printable block of command counts, error rates
+        and latencies since app restart."""
+        rows = {}
+        for (stage, command), h in sorted(registry.histograms.items()):
+            if stage == 'total':
+                rows[command] = (f'{h.count} runs, {h.errors} errors, '
+                                 f'p50 {h.percentile(50) * 1000:g}ms, '
+                                 f'p95 {h.percentile(95) * 1000:g}ms')
+        cache = self.xkcd.cache.stats()
+        rows['comic cache'] = (f"{cache['hits']} hits, "
+                               f"{cache['disk_hits']} disk hits, "
+                               f"{cache['misses']} misses")
+        response = self.text_to_blocks(
+            f'{self.name} has been running for {self.get_uptime()}.\n'
+            + formatted_dict(rows))
+        return response
+
     def handle_quit(self):
         """ Returns a printable block of a goodbye message."""
         logger.warning('Manual exit requested.')
-        response = self.text_to_blocks(f'See you next time!')
+        response = self.renderer.static('quit')
         return response
 
-    def handle_comic_request(self, request):
-        """ Adds comic number to history and returns
+    async def handle_comic_request(self, request, chan=BOT_CHAN):
+        """ Adds comic number to the channel's history and returns
         a printable block of the comic."""
-        comic_number, blocks = self.xkcd.handle_comic_request(request)
-        self.comic_history.append(comic_number)
+        seen = ()
+        if request == 'random-unseen':
+            seen = self.comic_history.get(chan)
+        try:
+            comic_number, blocks = await self.xkcd.handle_comic_request(
+                request, seen)
+        except UpstreamUnavailable as err:
+            logger.warning(f'{self} {err}')
+            return self.renderer.static('unavailable')
+        self.comic_history.append(chan, comic_number)
         response = blocks
         return response
 
-    def handle_next(self):
+    async def handle_batch(self, comic_numbers, chan=BOT_CHAN):
+        """ Fetches up to max_batch comics at once and returns them merged
+        into as few printable blocks as Slack allows.  A comic that
+        fails gets an error of its own instead of failing the batch."""
+        shown = comic_numbers[:self.max_batch]
+        results = await asyncio.gather(
+            *[self.xkcd.handle_comic_request(n) for n in shown],
+            return_exceptions=True)
+        payloads = []
+        for comic_number, result in zip(shown, results):
+            if isinstance(result, UpstreamUnavailable):
+                logger.warning(f'{self} {result}')
+                payloads.append(self.renderer.static('unavailable'))
+            elif isinstance(result, Exception):
+                logger.error(f'{self} failed to show comic {comic_number}',
+                             exc_info=result)
+                payloads.append(self.text_to_blocks(
+                    f'Something went wrong showing comic {comic_number}.'))
+            else:
+                comic_number, blocks = result
+                self.comic_history.append(chan, comic_number)
+                payloads.append(blocks)
+        if len(comic_numbers) > len(shown):
+            payloads.append(self.text_to_blocks(
+                f'Showing the first {len(shown)} of {len(comic_numbers)} '
+                f'comics: I show at most {self.max_batch} at a time.'))
+        return rendering.merge_blocks(payloads)
+
+    async def handle_range(self, args, chan=BOT_CHAN):
+        """ Returns printable blocks of a range of comics,
+        typed as 'range 100-110'."""
+        try:
+            start, end = (int(n) for n in ''.join(args).split('-'))
+        except ValueError:
+            return self.text_to_blocks(
+                "Try 'range 100-110' to see comics 100 through 110.")
+        if end < start:
+            start, end = end, start
+        # a range is sliced lazily, however long it is
+        return await self.handle_batch(range(start, end + 1), chan)
+
+    async def handle_next(self, chan=BOT_CHAN):
         """ Returns a printable block of the comic
-        published after the last one in the app's history.
+        published after the last one in the channel's history.
         Handles exception of there being an empty history."""
-        if self.comic_history:
-            response = self.handle_comic_request(
-                int(self.comic_history[-1]) + 1)
+        last = self.comic_history.last(chan)
+        if last is not None:
+            response = await self.handle_comic_request(last + 1, chan)
         else:
-            response = self.text_to_blocks(
-                'I\'m sorry.  There must be a first to be a next.\n'
-                'Please try this after you have requested a comic.')
+            response = self.renderer.static('no_next')
         return response
 
-    def handle_previous(self):
+    async def handle_previous(self, chan=BOT_CHAN):
         """ Returns a printable block of the comic
-        published prior to the last one in the app's history.
+        published prior to the last one in the channel's history.
         Handles exception of there being an empty history."""
-        if self.comic_history:
-            response = self.handle_comic_request(
-                int(self.comic_history[-1]) - 1)
+        last = self.comic_history.last(chan)
+        if last is not None:
+            response = await self.handle_comic_request(last - 1, chan)
         else:
-            response = self.text_to_blocks(
-                'I\'m sorry.  There must be a first to be a previous.\n'
-                'Please try this after you have requested a comic.')
+            response = self.renderer.static('no_previous')
         return response
 
-    def handle_api(self):
+    async def handle_api(self, chan=BOT_CHAN):
         """ This is a joke feature.  It returns a printable
         comic about the API for xkcd."""
         # 1481 is xkcd's comic about API's
-        response = self.handle_comic_request(1481)
+        response = await self.handle_comic_request(1481, chan)
         return response
 
-    def handle_history(self):
+    def handle_history(self, chan=BOT_CHAN):
         """ Returns a printable block of the list of
-        comic numbers shown since app restart."""
-        response = self.text_to_blocks(f'These are the comics shown since app restart:\
-            \n {self.comic_history}')
+        comic numbers last shown in the channel."""
+        response = self.text_to_blocks(f'These are the comics shown here:\
+            \n {self.comic_history.get(chan)}')
+        return response
+
+    def handle_search(self, args):
+        """ Returns a printable block of the stored comics
+        matching the search words."""
+        if self.search_index is None:
+            self.start_indexing()
+            return self.renderer.static('indexing')
+        query = ' '.join(args)
+        found = self.search_index.search(query)
+        if found:
+            lines = [f'{num}: {self.search_index.titles[num]}'
+                     for num in found]
+            response = self.text_to_blocks(
+                f"Comics matching '{query}':\n" + '\n'.join(lines))
+        else:
+            response = self.text_to_blocks(
+                f"No comics I know of match '{query}'.")
         return response
 
     def handle_not_command(self, cmd):
@@ -246,32 +532,37 @@ class SlackClient:
         logger.error(f'{self} Unknown command: {cmd}')
         return response
 
-    def on_goodbye(self, **payload):
+    async def on_goodbye(self, **payload):
         """Slack has decided to terminate our instance"""
-        self.post_message(self.text_to_blocks('Goodbye, cruel world...'))
-        logger.warning('f{self} is disconnecting.')
+        await self.post_message(self.renderer.static('goodbye'))
+        logger.warning(f'{self} is disconnecting.')
 
     def text_to_blocks(self, message):
         """ Returns a printable blocks format of a text message."""
-        blocks = [{
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": message
-            }
-        }]
-        blocks = json.dumps(blocks)
-        return blocks
-
-    def post_message(self, blocks=None, chan=BOT_CHAN):
+        return rendering.text_to_blocks(message)
+
+    async def post_message(self, blocks=None, chan=BOT_CHAN):
+        """Queues a message for a Slack channel"""
+        await self.outbound.put(chan, blocks)
+
+    async def send_message(self, chan, blocks):
         """Sends a message to a Slack channel"""
+        web_client = self.web_client or self.sc._web_client
         # make sure that we have an actual WebClient instance
-        assert self.sc._web_client is not None
-        self.sc._web_client.chat_postMessage(
-            channel=chan,
-            as_user=False,
-            blocks=blocks
-        )
+        assert web_client is not None
+        start = time.perf_counter()
+        try:
+            await web_client.chat_postMessage(
+                channel=chan,
+                as_user=False,
+                blocks=blocks
+            )
+        except Exception:
+            registry.observe('post', 'chat.postMessage',
+                             time.perf_counter() - start, True)
+            raise
+        registry.observe('post', 'chat.postMessage',
+                         time.perf_counter() - start)
 
     def get_uptime(self):
         """ Return how long the client has been connected """
@@ -279,26 +570,113 @@ class SlackClient:
 
     def check_goodbye(self, data):
         """ Checks incoming messages for goodbye messages
-        from the bot.  If found, kills the bot."""
+        from the bot.  If found, shuts the bot down."""
 
         if data.get('subtype') and (
                 data['subtype'] == 'bot_message') and (
                 data['text'] == 'See you next time!'):
-            os.kill(os.getpid(), signal.SIGTERM)
+            self.begin_shutdown()
+
+    def begin_shutdown(self):
+        """ Starts the shutdown sequence, once"""
+        if self.shutdown_task is None:
+            self.shutdown_task = asyncio.ensure_future(self.shutdown())
+        return self.shutdown_task
+
+    async def shutdown(self):
+        """ Stops taking commands, gives the ones in flight and the
+        queued replies up to shutdown_timeout seconds to finish, saves
+        a snapshot for the next process, then disconnects."""
+        logger.warning(f'{self} is shutting down.')
+        self.draining = True
+        deadline = time.monotonic() + self.shutdown_timeout
+        await self.admission.drain(self.shutdown_timeout)
+        if self.tasks:
+            await asyncio.wait(set(self.tasks), timeout=max(
+                0, deadline - time.monotonic()))
+        try:
+            await asyncio.wait_for(self.outbound.join(),
+                                   max(0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            logger.warning(f'{self} gave up on '
+                           f'{self.outbound.queue.qsize()} queued replies')
+        await self.outbound.stop()
+        self.save_snapshot()
+        if self.sc is not None:
+            # async_stop() marks the client stopped only once the socket
+            # has closed: the read loop must not reconnect in between
+            self.sc.auto_reconnect = False
+            await self.sc.async_stop()
+
+    def save_snapshot(self):
+        """ Writes what a restarted bot needs to answer at once"""
+        if not self.snapshot_path:
+            return
+        state = {
+            'saved_at': time.time(),
+            'xkcd': self.xkcd.snapshot(),
+            'ingest': self.ingest.snapshot(),
+        }
+        # workers sharing a snapshot path each write their own tmp file
+        tmp = f'{self.snapshot_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp, self.snapshot_path)
+        except OSError:
+            logger.exception(f'Could not save snapshot to '
+                             f'{self.snapshot_path}')
+            return
+        logger.info(f'Saved snapshot to {self.snapshot_path}')
+
+    def load_snapshot(self):
+        """ Warms the caches from the last snapshot, if there is one.
+        Returns whether there was."""
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path) as f:
+                state = json.load(f)
+            age = max(0, time.time() - state['saved_at'])
+            self.xkcd.warm(state['xkcd'], age)
+            self.ingest.warm(state['ingest'])
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.exception(f'Could not load snapshot from '
+                             f'{self.snapshot_path}')
+            return False
+        logger.info(f'Loaded a snapshot from {age:.0f}s ago')
+        return True
+
+    async def close(self):
+        """ Releases the http session, the metrics server and the stores"""
+        if self.metrics_server is not None:
+            await self.metrics_server.cleanup()
+            self.metrics_server = None
+        await self.xkcd.close()
+        self.xkcd.cache.close()
+        self.comic_history.close()
 
     def run(self):
         """ Starts up the thread that watches Slack for messages"""
         logger.info("waiting for things to happen")
         loop = self.future.get_loop()
-        # wait until ctrl-C or SIGTERM / SIGINT
+        # look up the latest comic while we connect to Slack
+        loop.call_soon(self.xkcd.start_refresher)
+        # drain rather than drop everything on SIGTERM / SIGINT
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.begin_shutdown)
+        # wait until we have shut down, or lost the connection for good
         loop.run_until_complete(self.future)
+        loop.run_until_complete(self.begin_shutdown())
+        loop.run_until_complete(self.close())
         logger.info("done waiting for things. (end of 'run' function)")
 
 
 def main(args):
+    setup_logging()
     SlackClient(
-        os.environ['BOT_USER_TOKEN'],
-        os.environ['BOT_USER_ID']).run()
+        config.require('BOT_USER_TOKEN'),
+        config.get('BOT_USER_ID')).run()
 
 
 if __name__ == '__main__':
@@ -3,44 +3,108 @@
 
 import os
 import sys
+import time
+import shutil
 import argparse
+import asyncio
 import logging
-import logging.config
-import yaml
-
-from dotenv import load_dotenv
+import tempfile
+import importlib
 from datetime import datetime as dt
 
-from slack_client import SlackClient
-
-load_dotenv()
+import config
+from log_setup import config_logger, setup_logging
 
 # guard against Python 2
 if sys.version_info[0] < 3:
     raise RuntimeError('This program requires Python 3+ to work.')
 
 
-def config_logger():
-    """ Setup logging configuration """
-    with open('logging.yaml') as f:
-        config = yaml.safe_load(f.read())
-        logging.config.dictConfig(config)
-    return logging.getLogger(__name__)
-
-
 def create_parser(args):
     parser = argparse.ArgumentParser(description='Slack and xkcd Together')
     parser.add_argument('-l', '--loglevel',
                         default='INFO',
                         help=('Desired logging level'
                               '(DEBUG, INFO, WARNING, ERROR)'))
+    parser.add_argument('-s', '--sync', action='store_true',
+                        help=('Mirror every comic into the local comic '
+                              'cache, then exit'))
+    parser.add_argument('--sync-concurrency', type=int, default=8,
+                        help='How many comics to download at once')
+    parser.add_argument('-e', '--events', action='store_true',
+                        help=('Receive Slack Events API callbacks over '
+                              'HTTP instead of using the RTM websocket'))
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Worker processes serving events')
+    parser.add_argument('-p', '--port', type=int, default=3000,
+                        help='Port to receive events on')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help=('Print how long each import and initialization '
+                              'step takes, then exit without connecting'))
     ns = parser.parse_args(args)
     return ns
 
 
+def sync(concurrency):
+    """ Mirrors every comic's metadata into the local comic cache"""
+    from xkcd import AsyncXkcdApi
+    from mirror import sync_comics
+
+    async def run():
+        xkcd = AsyncXkcdApi()
+        try:
+            return await sync_comics(xkcd, concurrency)
+        finally:
+            await xkcd.close()
+    return asyncio.get_event_loop().run_until_complete(run())
+
+
+def profile_startup():
+    """ Prints a breakdown of startup time.  Nothing is sent over the
+    network: the Slack connection only starts when the bot runs.  The
+    comic cache, history log and snapshot are kept in a temporary
+    directory, so the profile neither creates nor reads the real ones."""
+    steps = []
+    workdir = tempfile.mkdtemp(prefix='slackxkcd-profile-')
+
+    def timed(step, func):
+        start = time.perf_counter()
+        result = func()
+        steps.append((step, time.perf_counter() - start))
+        return result
+
+    timed('load config (.env)', config.load)
+    os.environ.update(
+        COMIC_CACHE_DB=os.path.join(workdir, 'comics.db'),
+        HISTORY_LOG=os.path.join(workdir, 'history.log'),
+        SNAPSHOT_PATH=os.path.join(workdir, 'snapshot.json'))
+    timed('setup logging (yaml)', setup_logging)
+    for module in ('slack_client', 'slack', 'aiohttp'):
+        timed(f'import {module}', lambda: importlib.import_module(module))
+    slack_client = sys.modules['slack_client']
+    bot = timed('SlackClient()', lambda: slack_client.SlackClient(
+        bot_user_token=config.get('BOT_USER_TOKEN', 'xoxb-profile'),
+        bot_id=config.get('BOT_USER_ID')))
+
+    bot.future.cancel()
+    loop = bot.future.get_loop()
+    loop.run_until_complete(
+        asyncio.gather(bot.future, return_exceptions=True))
+    bot.xkcd.cache.close()
+    bot.comic_history.close()
+    shutil.rmtree(workdir)
+
+    total = sum(seconds for _, seconds in steps)
+    for step, seconds in steps + [('total', total)]:
+        print(f'{step:<24} {seconds * 1000:9.1f} ms')
+
+
 def main(args):
     ns = create_parser(args)
-    logger = config_logger()
+    if ns.profile_startup:
+        profile_startup()
+        return
+    logger = config_logger(__name__)
     logger.setLevel(ns.loglevel)
     loglevel = logging.getLevelName(logger.getEffectiveLevel())
     app_start_time = dt.now()
@@ -52,9 +116,19 @@ def main(args):
         f'          loglevel is {loglevel}\n'
         '-------------------------------------------------')
 
+    if ns.sync:
+        sync(ns.sync_concurrency)
+        return
+
+    if ns.events:
+        import events_api
+        events_api.serve(ns.workers, port=ns.port)
+        return
+
+    from slack_client import SlackClient
     with SlackClient(
-        bot_user_token=os.environ['BOT_USER_TOKEN'],
-        bot_id=os.environ['BOT_USER_ID']
+        bot_user_token=config.require('BOT_USER_TOKEN'),
+        bot_id=config.get('BOT_USER_ID')
     ) as bot:
         bot.run()
 
@@ -2,92 +2,448 @@
 
 import sys
 import logging
-import logging.config
-import yaml
-from dotenv import load_dotenv
-import requests
-from random import randint
-import json
+import time
+import asyncio
+from collections import OrderedDict
+from comic_cache import ComicCache
+from comic_index import ComicIndex
+from rendering import BlockRenderer
+from resilience import (CircuitBreaker, UpstreamUnavailable, retry)
+from metrics import registry
+import config
 
 # Guard against python2
 if sys.version_info[0] < 3:
     raise RuntimeError("Python 3 is required")
 
-load_dotenv()
+logger = logging.getLogger(__name__)
 
-# Create module logger from config file
+COMIC_NOT_FOUND = 1969  # a comic about a 404 error
 
 
-def config_logger():
-    """ Setup logging configuration """
-    with open('logging.yaml') as f:
-        config = yaml.safe_load(f.read())
-        logging.config.dictConfig(config)
-    return logging.getLogger(__name__)
-
-
-logger = config_logger()
+class ComicNotFound(LookupError):
+    """ xkcd has no comic with the number asked for"""
 
 
 class XkcdApi:
+    """ The parts of the xkcd client that do no I/O: the latest comic
+    number and how to revalidate it, the comic cache and index, urls
+    and rendering.  AsyncXkcdApi does the fetching."""
 
-    def __init__(self):
-        self.base_url = 'https://www.xkcd.com/'
+    def __init__(self, cache=None, last_ttl=None):
+        self.base_url = config.get('XKCD_BASE_URL', 'https://www.xkcd.com/')
         self.json_ending = '/info.0.json'
         self.get_random_api = 'random'
         self.first = '1'
-        self.last = str(requests.get(
-            self.base_url + self.json_ending).json()["num"])
+        # The latest comic number is looked up on first use, not here,
+        # and is refreshed once it is older than last_ttl seconds.
+        self._last = None
+        self.last_checked = 0
+        self.last_ttl = last_ttl or config.get('LAST_COMIC_TTL', 3600, int)
+        self._etag = None
+        self._last_modified = None
+        self.connect_timeout = config.get('XKCD_CONNECT_TIMEOUT', 2, float)
+        self.read_timeout = config.get('XKCD_READ_TIMEOUT', 3, float)
+        if cache is None:
+            cache = ComicCache(
+                max_size=config.get('COMIC_CACHE_SIZE', 256, int),
+                db_path=config.get('COMIC_CACHE_DB', 'comics.db'))
+        self.cache = cache
+        # the comic numbers worth asking xkcd for, grown along with last
+        self.index = ComicIndex()
+        self.renderer = BlockRenderer()
 
-    def construct_url(self, request):
-        """ Changes a descriptive request into a gettable url"""
-        if (isinstance(request, int) and
-                request > 0 and request < int(self.last)):
-            url = self.base_url + str(request) + self.json_ending
+    @property
+    def last(self):
+        """ The number of the most recent comic, as a string, or None
+        until it has been looked up.  Never blocks."""
+        return self._last
+
+    @last.setter
+    def last(self, value):
+        self._last = str(value)
+        self.last_checked = time.monotonic()
+        self.index.extend(int(value))
+
+    def last_is_stale(self):
+        """ Whether the latest comic number is due for a refresh"""
+        return time.monotonic() - self.last_checked > self.last_ttl
+
+    def latest_headers(self):
+        """ Returns conditional request headers for the latest comic,
+        so an unchanged comic costs a 304 instead of a full body"""
+        headers = {}
+        if self._last is not None:
+            if self._etag:
+                headers['If-None-Match'] = self._etag
+            if self._last_modified:
+                headers['If-Modified-Since'] = self._last_modified
+        return headers
+
+    def accept_latest(self, status, headers, comic_object=None):
+        """ Records the answer to a latest comic request"""
+        if status == 304:
+            self.last_checked = time.monotonic()
+            return
+        self._etag = headers.get('ETag')
+        self._last_modified = headers.get('Last-Modified')
+        self.cache.put(comic_object['num'], comic_object)
+        if self._last != str(comic_object['num']):
+            logger.info(f'Latest xkcd comic is {comic_object["num"]}')
+        self.last = comic_object['num']
+
+    def construct_number(self, request, seen=()):
+        """ Changes a descriptive request into a comic number,
+        or None if there is no such comic.  'random-unseen'
+        picks a comic that is not in seen."""
+        if isinstance(request, int):
+            return request if request in self.index else None
         elif request == 'random':
-            url = self.base_url + \
-                str(randint(1, int(self.last))) + self.json_ending
+            return self.index.random()
+        elif request == 'random-unseen':
+            return self.index.random(exclude=set(seen))
         elif request == 'first':
-            url = self.base_url + self.first + self.json_ending
+            return int(self.first)
         elif request == 'last':
-            url = self.base_url + self.last + self.json_ending
-        else:
+            return self.index.last
+        return None
+
+    def construct_url(self, request):
+        """ Changes a descriptive request into a gettable url"""
+        comic_number = self.construct_number(request)
+        if comic_number is None:
             return "invalid"
-        return url
+        return self.comic_url(comic_number)
+
+    def comic_url(self, comic_number):
+        """ Returns the json url of a comic number"""
+        return self.base_url + str(comic_number) + self.json_ending
+
+    def construct_blocks(self, comic_object):
+        """ Returns the JSON format block object used for printing in Slack.
+        Each comic is serialized once and then served from the renderer."""
+        return self.renderer.comic(comic_object)
+
+
+def is_transient(err):
+    """ Whether an error from xkcd is worth retrying"""
+    import aiohttp
+    if isinstance(err, aiohttp.ClientResponseError):
+        return err.status >= 500
+    return isinstance(err, (asyncio.TimeoutError,
+                            aiohttp.ClientConnectionError))
+
+
+def consume_error(future):
+    """ Marks the error of a background future as retrieved"""
+    if not future.cancelled():
+        future.exception()
+
+
+class AsyncXkcdApi(XkcdApi):
+    """ A non-blocking XkcdApi for use inside the RTM event loop.
+    Comic fetches share a pooled keep-alive aiohttp session, so the
+    loop keeps serving other messages while a fetch is in flight.
+
+    Every fetch has connect and read timeouts, is retried with jittered
+    backoff, and goes through a circuit breaker.  A command waits at most
+    `budget` seconds for xkcd; a fetch that takes longer carries on in
+    the background and fills the cache for the next request."""
+
+    def __init__(self, cache=None, last_ttl=None, pool_size=None,
+                 prefetch_window=None, prefetch_concurrency=None,
+                 prefetch_backlog=32):
+        super().__init__(cache, last_ttl)
+        self.pool_size = pool_size or config.get('XKCD_POOL_SIZE', 10, int)
+        self._session = None
+        self._refresher = None
+        # Neighbouring comics are prefetched after each request, at a
+        # lower priority: at most prefetch_concurrency at a time, and
+        # only while user requests leave room in the pool.  Comics wait
+        # newest first, and the oldest are dropped past prefetch_backlog.
+        if prefetch_window is None:
+            prefetch_window = config.get('COMIC_PREFETCH_WINDOW', 1, int)
+        self.prefetch_window = prefetch_window
+        self.prefetch_concurrency = prefetch_concurrency or config.get(
+            'COMIC_PREFETCH_CONCURRENCY', 4, int)
+        self.prefetch_backlog = prefetch_backlog
+        self._prefetch_waiting = OrderedDict()
+        self._prefetches = set()
+        self.active_requests = 0
+        self.prefetched = 0
+        self.prefetch_dropped = 0
+        # Fetches in flight, so concurrent requests can share them
+        self._inflight = {}
+        self.upstream_fetches = 0
+        self.coalesced = 0
+        self.budget = config.get('COMMAND_BUDGET', 5, float)
+        self.breaker = CircuitBreaker('xkcd')
+
+    def _get_session(self):
+        """ Lazily creates the shared session on the running loop"""
+        import aiohttp
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size, keepalive_timeout=60)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout,
+                                            sock_read=self.read_timeout)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=timeout)
+        return self._session
 
-    def handle_comic_request(self, request):
+    async def request_json(self, url, headers=None):
+        """ GETs a json url from xkcd through the circuit breaker,
+        retrying timeouts, connection errors and 5xx answers.
+        Returns the status, the headers and the decoded body."""
+        self.breaker.allow()
+
+        async def attempt():
+            async with self._get_session().get(url, headers=headers) as resp:
+                resp.raise_for_status()
+                body = None
+                if resp.status != 304:
+                    body = await resp.json(content_type=None)
+                return resp.status, resp.headers, body
+        start = time.perf_counter()
+        try:
+            result = await retry(attempt, is_transient,
+                                 deadline=time.monotonic() + self.budget)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            registry.observe('fetch', 'xkcd', time.perf_counter() - start,
+                             True)
+            if is_transient(err):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        registry.observe('fetch', 'xkcd', time.perf_counter() - start)
+        self.breaker.record_success()
+        return result
+
+    async def within_budget(self, key, fetch):
+        """ Waits up to the command budget for a single flight fetch.
+        If the budget runs out the fetch carries on in the background."""
+        import aiohttp
+        flight = asyncio.ensure_future(self.single_flight(key, fetch))
+        flight.add_done_callback(consume_error)
+        try:
+            return await asyncio.wait_for(asyncio.shield(flight), self.budget)
+        except asyncio.TimeoutError as err:
+            raise UpstreamUnavailable(
+                f'xkcd did not answer for {key} within {self.budget}s'
+            ) from err
+        except aiohttp.ClientError as err:
+            raise UpstreamUnavailable(
+                f'xkcd failed to answer for {key}: {err}') from err
+
+    async def get_comic(self, comic_number):
+        """ Returns the comic object for a comic number, from the
+        cache if we have seen it before, otherwise from xkcd."""
+        comic_object = self.cache.get(comic_number)
+        if comic_object is None:
+            comic_object = await self.within_budget(
+                comic_number, lambda: self.fetch_comic(comic_number))
+        return comic_object
+
+    async def fetch_comic(self, comic_number):
+        """ Fetches a comic object from xkcd and caches it"""
+        import aiohttp
+        self.upstream_fetches += 1
+        try:
+            _, _, comic_object = await self.request_json(
+                self.comic_url(comic_number))
+        except aiohttp.ClientResponseError as err:
+            if err.status != 404:
+                raise
+            self.index.discard(comic_number)
+            raise ComicNotFound(comic_number) from err
+        self.cache.put(comic_number, comic_object)
+        return comic_object
+
+    async def single_flight(self, key, fetch):
+        """ Runs fetch() for a key, unless a fetch for that key is already
+        in flight.  Then we wait for it and share its result or error."""
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as err:
+            future.set_exception(err)
+            # mark the error as retrieved in case nobody else was waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._inflight[key]
+
+    async def refresh_last(self):
+        """ Looks up the latest comic number from xkcd"""
+        try:
+            status, headers, comic_object = await self.request_json(
+                self.base_url + self.json_ending, self.latest_headers())
+            self.accept_latest(status, headers, comic_object)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            if self._last is None:
+                raise
+            logger.exception('Could not refresh latest comic, keeping '
+                             f'{self._last}')
+            self.last_checked = time.monotonic()
+
+    async def ensure_last(self):
+        """ Resolves the latest comic number if we do not have one yet.
+        Afterwards the background refresher keeps it current; should it
+        fall behind, the stale number is served while we look again."""
+        if self._last is None:
+            await self.within_budget('last', self.refresh_last)
+        elif self.last_is_stale() and 'last' not in self._inflight:
+            refresh = asyncio.ensure_future(
+                self.single_flight('last', self.refresh_last))
+            refresh.add_done_callback(consume_error)
+
+    def start_refresher(self):
+        """ Starts the background task that keeps the
+        latest comic number fresh"""
+        if self._refresher is None or self._refresher.done():
+            self._refresher = asyncio.ensure_future(self._refresh_forever())
+
+    async def _refresh_forever(self):
+        while True:
+            try:
+                await self.single_flight('last', self.refresh_last)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Could not look up the latest comic')
+            await asyncio.sleep(self.last_ttl)
+
+    def prefetch_around(self, comic_number):
+        """ Queues background fetches of the comics either side of
+        a comic, so next and previous are answered from the cache"""
+        for offset in range(1, self.prefetch_window + 1):
+            for neighbour in (comic_number + offset, comic_number - offset):
+                if (neighbour in self.index and
+                        neighbour not in self._prefetch_waiting and
+                        neighbour not in self._inflight and
+                        neighbour not in self.cache):
+                    self._prefetch_waiting[neighbour] = None
+                    if len(self._prefetch_waiting) > self.prefetch_backlog:
+                        self._prefetch_waiting.popitem(last=False)
+                        self.prefetch_dropped += 1
+        self._pump_prefetches()
+
+    def _pump_prefetches(self):
+        """ Starts waiting prefetches, newest first, while there is
+        room for them next to user requests"""
+        while (self._prefetch_waiting and
+               len(self._prefetches) < self.prefetch_concurrency and
+               self.active_requests + len(self._prefetches) <
+               self.pool_size):
+            comic_number, _ = self._prefetch_waiting.popitem()
+            if comic_number in self._inflight or comic_number in self.cache:
+                continue
+            task = asyncio.ensure_future(self._prefetch(comic_number))
+            self._prefetches.add(task)
+            task.add_done_callback(self._prefetch_done)
+
+    def _prefetch_done(self, task):
+        self._prefetches.discard(task)
+        self._pump_prefetches()
+
+    async def _prefetch(self, comic_number):
+        try:
+            await self.single_flight(
+                comic_number, lambda: self.fetch_comic(comic_number))
+            self.prefetched += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.debug(f'Could not prefetch comic {comic_number}: {err}')
+
+    async def handle_comic_request(self, request, seen=()):
+        """ Returns a printable comic block and a comic number,
+        given a descriptive request.  Its neighbours are prefetched."""
+        self.active_requests += 1
+        try:
+            comic_number, blocks = await self.find_comic(request, seen)
+        finally:
+            self.active_requests -= 1
+        self.prefetch_around(comic_number)
+        return comic_number, blocks
+
+    async def find_comic(self, request, seen=()):
         """ Returns a printable comic block and a comic number,
         given a descriptive request"""
-        nonworking_links = [404, 1663]
-        comic_not_found = 1969  # returns a comic about a 404 error
-
-        if request in nonworking_links:
-            request = comic_not_found
-
-        if isinstance(request, int) or request in ['first', 'last', 'random']:
-            comic_json_url = self.construct_url(request)
-            if comic_json_url == "invalid":
-                comic_json_url = self.construct_url(comic_not_found)
-            comic_object = requests.get(
-                comic_json_url).json()
-        else:
-            return self.handle_comic_request(comic_not_found)
+        await self.ensure_last()
+        comic_number = self.construct_number(request, seen)
+        try:
+            if comic_number is None:
+                raise ComicNotFound(request)
+            comic_object = await self.get_comic(comic_number)
+        except ComicNotFound:
+            comic_object = await self.get_comic(COMIC_NOT_FOUND)
         blocks = self.construct_blocks(comic_object)
         comic_number = comic_object['num']
         return comic_number, blocks
 
-    def construct_blocks(self, comic_object):
-        """ Returns the JSON format block object used for printing in Slack"""
-
-        blocks = [{
-            "type": "image",
-            "title": {
-                "type": "plain_text",
-                "text": comic_object['title']
-            },
-            "image_url": comic_object['img'],
-            "alt_text": comic_object['alt']
+    def snapshot(self):
+        """ Returns what a restarted process needs to answer at once:
+        the latest comic and how to revalidate it, the comics known to
+        be missing, and the comics hot in memory"""
+        return {
+            'last': self._last,
+            'etag': self._etag,
+            'last_modified': self._last_modified,
+            'last_age': time.monotonic() - self.last_checked,
+            'missing': sorted(self.index.missing),
+            'hot': self.cache.hot(),
+        }
+
+    def warm(self, state, age=0):
+        """ Restores a snapshot taken `age` seconds ago.  Its latest
+        comic is served right away, and revalidated in the background
+        once it is older than last_ttl."""
+        self.index.missing.update(state.get('missing', ()))
+        if state.get('last') is not None:
+            self._etag = state.get('etag')
+            self._last_modified = state.get('last_modified')
+            self.last = state['last']
+            self.last_checked -= state.get('last_age', 0) + age
+        for comic_object in self.cache.warm(state.get('hot', [])):
+            self.renderer.comic(comic_object)
+
+    def stats(self):
+        """ Returns how many upstream fetches were made, and how
+        many were saved by sharing an in-flight fetch"""
+        return {
+            'upstream_fetches': self.upstream_fetches,
+            'coalesced': self.coalesced,
+            'inflight': len(self._inflight),
+            'prefetched': self.prefetched,
+            'prefetch_waiting': len(self._prefetch_waiting),
+            'prefetch_dropped': self.prefetch_dropped,
+            'circuit': self.breaker.state,
+            'circuit_rejected': self.breaker.rejected,
         }
-        ]
-        blocks = json.dumps(blocks)
-        return blocks
+
+    async def close(self):
+        """ Stops the refresher and closes the shared http session"""
+        if self._refresher is not None:
+            self._refresher.cancel()
+        self._prefetch_waiting.clear()
+        for task in list(self._prefetches):
+            task.cancel()
+        if self._session is not None:
+            await self._session.close()